@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2020 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compare the training throughput of `genienlp train` in a single process with CPU data parallel training
+(`genienlp train --cpu_workers K`), on a small Seq2Seq model.
+
+Every configuration trains on the same global batch: with K workers, each worker gets --train_batch_tokens / K
+tokens per batch and os.cpu_count() // K threads, and gradients are all-reduced through gloo. Each configuration
+is trained twice, for --iterations and for twice as many iterations, and the difference between the two runs is the
+time of the extra iterations alone, without loading the data, the embeddings and the model.
+
+The tests/dataset almond task only checks that everything runs; use --data and --task with a real dataset for
+meaningful numbers. Arguments after -- are passed to `genienlp train` (e.g. to change the model).
+
+Usage: python3 benchmarks/cpu_data_parallel.py [--workers 2 4 8] [--iterations 50] [--embeddings .embeddings] [-- ...]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def train(args, num_workers, iterations):
+    with tempfile.TemporaryDirectory() as savedir:
+        command = [sys.executable, '-m', 'genienlp', 'train', '--train_tasks', args.task, '--data', args.data,
+                   '--embeddings', args.embeddings, '--save', savedir, '--exist_ok', '--skip_cache', '--no_commit',
+                   '--preserve_case', '--no_tensorboard', '--train_iterations', str(iterations),
+                   '--train_batch_tokens', str(args.train_batch_tokens // max(num_workers, 1)),
+                   '--encoder_embeddings', args.encoder_embeddings, '--decoder_embeddings', args.decoder_embeddings,
+                   '--dimension', str(args.dimension), '--seed', str(args.seed),
+                   # no validation, and a single checkpoint at the end, in both runs
+                   '--log_every', str(iterations), '--val_every', str(2 * iterations),
+                   '--save_every', str(2 * iterations)]
+        if num_workers > 0:
+            command += ['--cpu_workers', str(num_workers)]
+        command += args.train_args
+        # train on the CPU even if there is a GPU
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+        start = time.perf_counter()
+        subprocess.run(command, env=env, cwd=SRCDIR, check=True, stdout=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+
+def seconds_per_iteration(args, num_workers):
+    short = train(args, num_workers, args.iterations)
+    long = train(args, num_workers, 2 * args.iterations)
+    return (long - short) / args.iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default=[2, 4, 8], nargs='+', type=int)
+    parser.add_argument('--iterations', default=50, type=int)
+    parser.add_argument('--train_batch_tokens', default=4000, type=int, help='global batch size (number of tokens)')
+    parser.add_argument('--task', default='almond')
+    parser.add_argument('--data', default=os.path.join(SRCDIR, 'tests', 'dataset'))
+    parser.add_argument('--embeddings', default=os.path.join(SRCDIR, '.embeddings'))
+    parser.add_argument('--encoder_embeddings', default='small_glove+char')
+    parser.add_argument('--decoder_embeddings', default='small_glove+char')
+    parser.add_argument('--dimension', default=200, type=int)
+    parser.add_argument('--seed', default=123, type=int)
+    parser.add_argument('train_args', nargs=argparse.REMAINDER, help='-- followed by more arguments for genienlp train')
+    args = parser.parse_args()
+    if args.train_args[:1] == ['--']:
+        args.train_args = args.train_args[1:]
+
+    baseline = seconds_per_iteration(args, 0)
+    print('processes | threads each | iterations/s | speedup')
+    print(f'{"single":>9} | {os.cpu_count() or 1:12d} | {1 / baseline:12.2f} | {1:7.2f}')
+    for num_workers in args.workers:
+        elapsed = seconds_per_iteration(args, num_workers)
+        threads = max(1, (os.cpu_count() or 1) // num_workers)
+        print(f'{num_workers:9d} | {threads:12d} | {1 / elapsed:12.2f} | {baseline / elapsed:7.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2020 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compare the packed and the unpacked (one sequence at a time) paths of PackedLSTM for different batch sizes.
+
+The batch size where the packed path becomes faster is a good value for PackedLSTM's max_unpacked_batch_size.
+
+Usage: python3 benchmarks/packed_lstm.py [--device cuda] [--dimension 200] [--max_length 40]
+"""
+
+import argparse
+import time
+
+import torch
+
+from genienlp.models.common import PackedLSTM
+
+
+def benchmark(lstm, inputs, lengths, repeat, device):
+    with torch.no_grad():
+        for _ in range(3):
+            lstm(inputs, lengths)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            lstm(inputs, lengths)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--dimension', default=200, type=int)
+    parser.add_argument('--num_layers', default=1, type=int)
+    parser.add_argument('--max_length', default=40, type=int)
+    parser.add_argument('--batch_sizes', default=[1, 2, 4, 8, 16, 32, 64], nargs='+', type=int)
+    parser.add_argument('--repeat', default=50, type=int)
+    parser.add_argument('--seed', default=123, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    packed = PackedLSTM(args.dimension, args.dimension, bidirectional=True, num_layers=args.num_layers,
+                        max_unpacked_batch_size=0).to(device).eval()
+    unpacked = PackedLSTM(args.dimension, args.dimension, bidirectional=True, num_layers=args.num_layers,
+                          max_unpacked_batch_size=max(args.batch_sizes)).to(device).eval()
+    unpacked.load_state_dict(packed.state_dict())
+
+    print('batch size | packed (ms) | unpacked (ms)')
+    for batch_size in args.batch_sizes:
+        inputs = torch.randn(batch_size, args.max_length, args.dimension, device=device)
+        # at least two different lengths, so neither path takes the shortcut for uniform lengths
+        lengths = torch.randint(1, args.max_length + 1, (batch_size,), device=device)
+        lengths[0] = args.max_length
+        if batch_size > 1:
+            lengths[1] = max(1, args.max_length // 2)
+
+        packed_time = benchmark(packed, inputs, lengths, args.repeat, device)
+        unpacked_time = benchmark(unpacked, inputs, lengths, args.repeat, device)
+        print(f'{batch_size:10d} | {packed_time:11.3f} | {unpacked_time:13.3f}')
+
+
+if __name__ == '__main__':
+    main()
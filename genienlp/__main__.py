@@ -29,30 +29,40 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import importlib
+import sys
 
-from . import arguments, train, predict, server, cache_embeddings, export
-from .paraphrase import run_lm_finetuning, run_generation
-
+# subcommands are imported lazily, so that we only pay for importing (and initializing) torch, transformers and
+# the rest of the stack of the subcommand we actually run
 subcommands = {
-    'train': ('Train a model', arguments.parse_argv, train.main),
-    'export': ('Export a trained model for serving', export.parse_argv, export.main),
-    'predict': ('Evaluate a model, or compute predictions on a test dataset', predict.parse_argv, predict.main),
-    'server': ('Export RPC interface to predict', server.parse_argv, server.main),
-    'cache-embeddings': ('Download and cache embeddings', cache_embeddings.parse_argv, cache_embeddings.main),
-    'train-paraphrase': ('Train a paraphraser model', run_lm_finetuning.parse_argv, run_lm_finetuning.main),
-    'run-paraphrase': ('Run a paraphraser model', run_generation.parse_argv, run_generation.main)
+    'train': ('Train a model', 'arguments', 'train'),
+    'export': ('Export a trained model for serving', 'export', 'export'),
+    'predict': ('Evaluate a model, or compute predictions on a test dataset', 'predict', 'predict'),
+    'server': ('Export RPC interface to predict', 'server', 'server'),
+    'cache-embeddings': ('Download and cache embeddings', 'cache_embeddings', 'cache_embeddings'),
+    'train-paraphrase': ('Train a paraphraser model', 'paraphrase.run_lm_finetuning', 'paraphrase.run_lm_finetuning'),
+    'run-paraphrase': ('Run a paraphraser model', 'paraphrase.run_generation', 'paraphrase.run_generation')
 }
 
 
+def _import(module_name):
+    return importlib.import_module('.' + module_name, __package__)
+
+
 def main():
     parser = argparse.ArgumentParser(prog='genienlp')
     subparsers = parser.add_subparsers(dest='subcommand')
+
+    # only the subcommand being invoked needs its arguments; the others only need to be listed in --help
+    requested = next((arg for arg in sys.argv[1:] if not arg.startswith('-')), None)
     for subcommand in subcommands:
-        helpstr, get_parser, command_fn = subcommands[subcommand]
-        get_parser(subparsers.add_parser(subcommand, help=helpstr))
+        helpstr, parser_module, _main_module = subcommands[subcommand]
+        subparser = subparsers.add_parser(subcommand, help=helpstr)
+        if subcommand == requested:
+            _import(parser_module).parse_argv(subparser)
 
     argv = parser.parse_args()
-    subcommands[argv.subcommand][2](argv)
+    _import(subcommands[argv.subcommand][2]).main(argv)
 
 
 if __name__ == '__main__':
@@ -177,6 +177,15 @@ def parse_argv(parser):
     parser.add_argument('--train_question_embeddings_after', type=int, default=0,
                         help='back propagate into pretrained context embedding after the given iteration (default: '
                              'immediately)')
+    parser.add_argument('--tie_transformer_embeddings', action='store_true',
+                        help='share a single copy of a pretrained Transformer model used by both the context and the question '
+                             '(by default, each is an untied copy, fine-tuned separately)')
+    parser.add_argument('--frozen_embeddings_cache', default=None, type=str,
+                        help='cache the output of pretrained Transformer embeddings while they are not trained; use "memory" '
+                             'to keep the cache in memory, or a directory to keep it on disk (dropout is not applied '
+                             'to cached embeddings)')
+    parser.add_argument('--frozen_embeddings_cache_max_memory', default=4.0, type=float,
+                        help='maximum size of the in-memory cache of pretrained Transformer embeddings, in GB')
     parser.add_argument('--decoder_embeddings', default='glove+char',
                         help='which pretrained word embedding to use on the decoder side')
     parser.add_argument('--trainable_encoder_embeddings', default=0, type=int,
@@ -210,6 +219,19 @@ def parse_argv(parser):
     parser.add_argument('--lr_rate', default=0.001, type=float, help='fixed learning rate (if not using warmup)')
     parser.add_argument('--weight_decay', default=0.0, type=float, help='weight L2 regularization')
     parser.add_argument('--gradient_accumulation_steps', default=1, type=int, help='Number of accumulation steps. Useful to effectively get larger batch sizes.')
+    parser.add_argument('--auto_batch_size', action='store_true',
+                        help='choose --train_batch_tokens and --gradient_accumulation_steps at startup, based on how much fits '
+                             'in the memory of the device, and back off instead of failing when running out of memory later')
+    parser.add_argument('--target_batch_tokens', default=None, type=int,
+                        help='number of tokens per parameter update with --auto_batch_size (defaults to train_batch_tokens '
+                             'times gradient_accumulation_steps)')
+    parser.add_argument('--fp16', action='store_true',
+                        help='train with float16 automatic mixed precision and gradient scaling (requires a CUDA device and PyTorch 1.6 or later)')
+    parser.add_argument('--bf16', action='store_true',
+                        help='train with bfloat16 automatic mixed precision, on CPU or CUDA (requires PyTorch 1.10 or later)')
+    parser.add_argument('--checkpoint_activations', action='store_true',
+                        help='save memory by recomputing the activations of each transformer, coattention and fine-tuned '
+                             'pretrained embedding layer in the backward pass, instead of storing them (slower)')
     
 
     parser.add_argument('--load', default=None, type=str, help='path to checkpoint to load model from inside args.save')
@@ -218,6 +240,28 @@ def parse_argv(parser):
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('--devices', default=[0], nargs='+', type=int,
                         help='a list of devices that can be used for training')
+    parser.add_argument('--async_validation', action='store_true',
+                        help='validate in a background process, on a snapshot of the model, while training continues')
+    parser.add_argument('--async_validation_device', default=None, type=int,
+                        help='device to use for --async_validation (defaults to the CPU)')
+    parser.add_argument('--distributed', action='store_true',
+                        help='train with DistributedDataParallel, using one process for each device in --devices')
+    parser.add_argument('--dist_backend', default='gloo', choices=['gloo', 'nccl'],
+                        help='torch.distributed backend to use for distributed training (gloo also works on CPU)')
+    parser.add_argument('--num_nodes', default=1, type=int,
+                        help='number of machines taking part in distributed training; each one runs one process per device')
+    parser.add_argument('--node_rank', default=0, type=int, help='index of this machine in distributed training')
+    parser.add_argument('--dist_url', default=None, type=str,
+                        help='URL used to initialize distributed training (e.g. tcp://host:port); defaults to a '
+                             'synchronization file in the save directory, which must be shared by all the machines')
+    parser.add_argument('--dist_timeout', default=180, type=int,
+                        help='minutes a distributed process waits for the others before failing; the other processes '
+                             'wait for rank 0 while it validates, so this must be longer than validation')
+    parser.add_argument('--cpu_workers', default=0, type=int,
+                        help='when training on CPU, train with this many data parallel processes (implies --distributed)')
+    parser.add_argument('--threads_per_worker', default=None, type=int,
+                        help='number of intra-op threads of each --cpu_workers process (defaults to splitting the '
+                             'available cores evenly)')
 
     parser.add_argument('--no_commit', action='store_false', dest='commit',
                         help='do not track the git commit associated with this training run')
@@ -267,6 +311,9 @@ def post_parse(args):
     if args.use_encoder_loss and not (args.sentence_batching and len(args.train_languages.split('+')) > 1) :
         raise ValueError('To use encoder loss you must use sentence batching and use more than one language during training.')
 
+    if args.fp16 and args.bf16:
+        raise ValueError('--fp16 and --bf16 cannot be used together')
+
     if args.override_context and args.append_question_to_context_too:
         raise ValueError('You cannot use append_question_to_context_too when overriding context')
     
@@ -315,6 +362,11 @@ def post_parse(args):
         args.train_context_embeddings = args.train_encoder_embeddings
     if args.train_question_embeddings is None:
         args.train_question_embeddings = args.train_encoder_embeddings
+    if args.tie_transformer_embeddings and \
+            (args.train_context_embeddings != args.train_question_embeddings or
+             args.train_context_embeddings_after != args.train_question_embeddings_after):
+        raise ValueError('--tie_transformer_embeddings requires the context and question embeddings to be trained '
+                         'together, with the same --train_*_embeddings and --train_*_embeddings_after')
 
     args.log_dir = args.save
     if args.tensorboard_dir is None:
@@ -28,9 +28,17 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import contextlib
+import copy
+import hashlib
+import json
+import pickle
+import tempfile
 import torch
+from torch.utils.checkpoint import checkpoint
 import os
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from transformers import AutoTokenizer, AutoModel, AutoConfig, \
     BERT_PRETRAINED_MODEL_ARCHIVE_LIST, XLM_ROBERTA_PRETRAINED_MODEL_ARCHIVE_LIST
@@ -52,6 +60,21 @@ class EmbeddingOutput(NamedTuple):
     all_layers: List[torch.Tensor]
     last_layer: torch.Tensor
 
+def grow_capacity(storage, size, new_size):
+    """
+    Ensure that `storage` has room for at least `new_size` rows along the first dimension.
+
+    If it does not, a new tensor with double the capacity is allocated and the first `size` rows are copied over,
+    so that growing one row at a time costs amortized O(1). Only the first `new_size` rows of the returned
+    tensor are meaningful.
+    """
+    if new_size <= storage.size(0):
+        return storage
+    new_storage = storage.new_empty((max(new_size, 2 * storage.size(0)),) + tuple(storage.shape[1:]))
+    new_storage[:size] = storage[:size]
+    return new_storage
+
+
 class WordVectorEmbedding(torch.nn.Module):
     def __init__(self, vec_collection):
         super().__init__()
@@ -60,15 +83,22 @@ class WordVectorEmbedding(torch.nn.Module):
         self.num_layers = 0
         self.embedding = None
 
+        # the embedding matrix is over-allocated, so we can grow it without copying it every time;
+        # the weight of self.embedding is a view of the first _size rows
+        self._vectors = None
+        self._size = 0
+
     def init_for_vocab(self, vocab):
         vectors = torch.empty(len(vocab), self.dim, device=torch.device('cpu'))
         for ti, token in enumerate(vocab.itos):
             vectors[ti] = self._vec_collection[token.strip()]
 
+        self._vectors = vectors
+        self._size = len(vocab)
+
         # wrap in a list so it will not be saved by torch.save and it will not
         # be moved around by .to() and similar methods
-        self.embedding = [torch.nn.Embedding(len(vocab.itos), self.dim)]
-        self.embedding[0].weight.data = vectors
+        self.embedding = [torch.nn.Embedding(len(vocab.itos), self.dim, _weight=vectors)]
 
     def grow_for_vocab(self, vocab, new_words):
         if not new_words:
@@ -84,7 +114,13 @@ class WordVectorEmbedding(torch.nn.Module):
             new_vectors.append(new_vector)
 
         if new_vectors:
-            self.embedding[0].weight.data = torch.cat([self.embedding[0].weight.data.cpu()] + new_vectors, dim=0)
+            new_size = self._size + len(new_vectors)
+            self._vectors = grow_capacity(self._vectors, self._size, new_size)
+            self._vectors[self._size:new_size] = torch.cat(new_vectors, dim=0)
+            self._size = new_size
+
+            self.embedding[0].weight.data = self._vectors[:new_size]
+            self.embedding[0].num_embeddings = new_size
 
     def forward(self, input: torch.Tensor, padding=None):
         last_layer = self.embedding[0](input.cpu()).to(input.device)
@@ -99,25 +135,220 @@ class WordVectorEmbedding(torch.nn.Module):
         # ignore attempts to move the word embedding
         pass
 
+class EmbeddingOutputCache(object):
+    """
+    Cache the output of a frozen pretrained embedding for each input sequence, either in memory or on disk.
+
+    Entries are keyed on the token ids of the sequence, and grouped by a fingerprint of the model weights,
+    so entries computed with different weights are never mixed.
+    Values are stored on CPU in half precision. In memory, the least recently used entries are evicted
+    beyond max_memory_bytes. On disk, entries are written atomically, so several processes can share the directory.
+    """
+
+    def __init__(self, cachedir=None, max_memory_bytes=4 * 1024 ** 3):
+        self._cachedir = cachedir
+        self._max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self.fingerprint = None
+
+    def reset(self, fingerprint=None):
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self.fingerprint = fingerprint
+
+    def _path(self, key):
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self._cachedir, self.fingerprint, digest[:2], digest + '.pth')
+
+    def get(self, key):
+        if self._cachedir is None:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            return value
+        try:
+            return torch.load(self._path(key))
+        except FileNotFoundError:
+            return None
+        except (EOFError, RuntimeError, pickle.UnpicklingError):
+            # a truncated entry, left by a process that was killed while writing it with an older version
+            return None
+
+    def put(self, key, value):
+        if self._cachedir is None:
+            if key in self._memory:
+                return
+            self._memory[key] = value
+            self._memory_bytes += value.numel() * value.element_size()
+            while self._memory_bytes > self._max_memory_bytes and len(self._memory) > 1:
+                _key, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.numel() * evicted.element_size()
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a unique temporary file, then rename it, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                torch.save(value, fp)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
 class TransformerEmbedding(torch.nn.Module):
-    def __init__(self, model):
+    def __init__(self, model, output_cache=None):
         super().__init__()
         model.config.output_hidden_states = True
         self.dim = model.config.hidden_size
         self.num_layers = model.config.num_hidden_layers
         self.model = model
+        # rows of the input embedding matrix beyond this are tokens added to the vocabulary, which are initialized
+        # randomly and can be added during training
+        self._pretrained_vocab_size = model.config.vocab_size
+        # recompute the activations of each layer in the backward pass instead of storing them, when fine-tuning
+        self.checkpoint_activations = False
+
+        # wrap in a list so it will not be considered a submodule
+        self._output_cache = [output_cache]
+        # digest of the embedding of each added token, part of the cache key of the sequences that contain it
+        self._added_token_digests = dict()
 
     def init_for_vocab(self, vocab):
+        # this must be the exact size of the vocabulary, because it is saved with the model
         self.model.resize_token_embeddings(len(vocab))
+        self._invalidate_cache()
 
     def grow_for_vocab(self, vocab, new_words):
-        self.model.resize_token_embeddings(len(vocab))
-
-    def forward(self, input: torch.Tensor, padding=None):
+        # resizing copies the whole embedding matrix, so we over-allocate by doubling its size
+        # token ids are always smaller than the size of the vocabulary, so the extra rows are never used
+        capacity = self.model.get_input_embeddings().num_embeddings
+        # the existing rows are preserved, so the cached outputs remain valid
+        if len(vocab) > capacity:
+            self.model.resize_token_embeddings(max(len(vocab), 2 * capacity))
+
+    @contextlib.contextmanager
+    def output_cache_disabled(self):
+        """Compute the embeddings without reading or filling the output cache, within the context"""
+        output_cache = self._output_cache[0]
+        self._output_cache[0] = None
+        try:
+            yield
+        finally:
+            self._output_cache[0] = output_cache
+
+    def _invalidate_cache(self):
+        if self._output_cache[0] is not None and self._output_cache[0].fingerprint is not None:
+            self._output_cache[0].reset()
+            self._added_token_digests = dict()
+
+    def _compute_fingerprint(self):
+        # the fingerprint does not depend on the size of the vocabulary, nor on the embeddings of the added tokens,
+        # so that growing the vocabulary keeps all the entries valid
+        hasher = hashlib.sha1()
+        config = self.model.config.to_dict()
+        config.pop('vocab_size', None)
+        hasher.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+        input_embeddings = self.model.get_input_embeddings().weight
+        for name, tensor in self.model.state_dict().items():
+            if tensor.data_ptr() == input_embeddings.data_ptr():
+                tensor = tensor[:self._pretrained_vocab_size]
+            hasher.update(name.encode('utf-8'))
+            hasher.update(tensor.detach().cpu().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def _cache_key(self, token_ids):
+        key = token_ids.numpy().tobytes()
+        added_tokens = torch.unique(token_ids[token_ids >= self._pretrained_vocab_size]).tolist()
+        if not added_tokens:
+            return key
+        # the embeddings of added tokens are not part of the fingerprint, so they are part of the key
+        input_embeddings = self.model.get_input_embeddings().weight
+        for token_id in added_tokens:
+            digest = self._added_token_digests.get(token_id)
+            if digest is None:
+                digest = hashlib.sha1(input_embeddings[token_id].detach().cpu().numpy().tobytes()).digest()
+                self._added_token_digests[token_id] = digest
+            key += digest
+        return key
+
+    def _forward(self, input: torch.Tensor, padding):
         last_hidden_state, _pooled, hidden_states = self.model(input, attention_mask=(~padding).to(dtype=torch.float))
 
         return EmbeddingOutput(all_layers=hidden_states, last_layer=last_hidden_state)
 
+    def _checkpointed_forward(self, input: torch.Tensor, padding):
+        # same computation as BertModel.forward, but each layer is run under torch.utils.checkpoint
+        embedding_output = self.model.embeddings(input_ids=input)
+        attention_mask = (~padding).to(dtype=embedding_output.dtype)
+        extended_attention_mask = (1.0 - attention_mask[:, None, None, :]) * -10000.0
+
+        hidden_states = [embedding_output]
+        hidden = embedding_output
+        for layer in self.model.encoder.layer:
+            hidden = checkpoint(layer, hidden, extended_attention_mask)[0]
+            hidden_states.append(hidden)
+
+        return EmbeddingOutput(all_layers=hidden_states, last_layer=hidden)
+
+    def _can_checkpoint(self):
+        # only BERT-like models expose their layers in a way we can run one at a time
+        return self.checkpoint_activations and self.training and torch.is_grad_enabled() and \
+            hasattr(self.model, 'embeddings') and hasattr(getattr(self.model, 'encoder', None), 'layer') and \
+            next(self.model.parameters()).requires_grad
+
+    def _cached_forward(self, input: torch.Tensor, padding):
+        cache = self._output_cache[0]
+        if cache.fingerprint is None:
+            cache.reset(self._compute_fingerprint())
+
+        cpu_input = input.cpu()
+        cpu_mask = ~padding.cpu()
+        keys = [self._cache_key(row[row_mask]) for row, row_mask in zip(cpu_input, cpu_mask)]
+        cached = [cache.get(key) for key in keys]
+
+        missing = [i for i, value in enumerate(cached) if value is None]
+        if missing:
+            missing_indices = torch.tensor(missing, dtype=torch.int64, device=input.device)
+            # compute without dropout, so the result does not depend on whether we hit the cache or not
+            was_training = self.model.training
+            self.model.eval()
+            with torch.no_grad():
+                computed = self._forward(input.index_select(0, missing_indices),
+                                         padding.index_select(0, missing_indices))
+            self.model.train(was_training)
+
+            # (num_layers + 1) x len(missing) x time x dim
+            computed = torch.stack(computed.all_layers, dim=0).to(device='cpu', dtype=torch.float16)
+            for j, i in enumerate(missing):
+                value = computed[:, j, cpu_mask[i]]
+                cache.put(keys[i], value)
+                cached[i] = value
+
+        num_layers = cached[0].size(0)
+        batch_size, max_length = input.size()
+        all_layers = torch.zeros((num_layers, batch_size, max_length, self.dim), dtype=torch.float16)
+        for i, value in enumerate(cached):
+            all_layers[:, i, cpu_mask[i]] = value
+        all_layers = all_layers.to(device=input.device, dtype=next(self.model.parameters()).dtype).unbind(0)
+
+        return EmbeddingOutput(all_layers=all_layers, last_layer=all_layers[-1])
+
+    def forward(self, input: torch.Tensor, padding=None):
+        if self._output_cache[0] is not None:
+            # all parameters are frozen or trained together, so it is sufficient to check one
+            if next(self.model.parameters()).requires_grad:
+                # the weights will change, so the cache is no longer valid
+                self._invalidate_cache()
+            else:
+                return self._cached_forward(input, padding)
+
+        if self._can_checkpoint():
+            return self._checkpointed_forward(input, padding)
+        return self._forward(input, padding)
+
 class PretrainedLMEmbedding(torch.nn.Module):
     def __init__(self, model_name, cachedir):
         super().__init__()
@@ -125,37 +356,48 @@ class PretrainedLMEmbedding(torch.nn.Module):
         pretrained_save_dict = torch.load(os.path.join(cachedir, model_name), map_location=torch.device('cpu'))
 
         self.itos = pretrained_save_dict['vocab']
-        self.stoi = defaultdict(lambda: 0, {
-            w: i for i, w in enumerate(self.pretrained_decoder_vocab_itos)
-        })
+        self.stoi = {w: i for i, w in enumerate(self.itos)}
+        self.unk_id = self.stoi.get('<unk>', 0)
         self.dim = pretrained_save_dict['settings']['nhid']
         self.num_layers = 1
         self.model = PretrainedLTSMLM(rnn_type=pretrained_save_dict['settings']['rnn_type'],
-                                      ntoken=len(self.pretrained_decoder_vocab_itos),
+                                      ntoken=len(self.itos),
                                       emsize=pretrained_save_dict['settings']['emsize'],
                                       nhid=pretrained_save_dict['settings']['nhid'],
                                       nlayers=pretrained_save_dict['settings']['nlayers'],
                                       dropout=0.0)
         self.model.load_state_dict(pretrained_save_dict['model'], strict=True)
 
-        self.vocab_to_pretrained = None
+        # maps each token id in our vocabulary to the token id in the pretrained vocabulary
+        # this is not a buffer because it depends on the vocabulary and should not be saved with the model;
+        # it is moved to the device of the input lazily, the first time it is used after it changes
+        # like the word vector embeddings, it is over-allocated, and only the first _vocab_size entries are valid
+        self.vocab_to_pretrained = torch.empty(0, dtype=torch.int64)
+        self._vocab_size = 0
 
-    def init_for_vocab(self, vocab):
-        self.vocab_to_pretrained = torch.empty(len(self.vocab), dtype=torch.int64)
+    def _map_tokens(self, tokens):
+        return torch.tensor([self.stoi.get(token, self.unk_id) for token in tokens], dtype=torch.int64)
 
-        unk_id = self.stoi['<unk>']
-        for ti, token in enumerate(vocab.itos):
-            if token in self.pretrained_decoder_vocab_stoi:
-                self.vocab_to_pretrained[ti] = self.stoi[token]
-            else:
-                self.vocab_to_pretrained[ti] = unk_id
+    def init_for_vocab(self, vocab):
+        self.vocab_to_pretrained = self._map_tokens(vocab.itos)
+        self._vocab_size = len(vocab)
 
     def grow_for_vocab(self, vocab, new_words):
-        self.init_for_vocab(vocab)
+        # the vocabulary only grows at the end, so we only need to map the tokens we have not seen yet
+        if self._vocab_size == len(vocab):
+            return
+        self.vocab_to_pretrained = grow_capacity(self.vocab_to_pretrained, self._vocab_size, len(vocab))
+        self.vocab_to_pretrained[self._vocab_size:len(vocab)] = self._map_tokens(vocab.itos[self._vocab_size:])
+        self._vocab_size = len(vocab)
 
     def forward(self, input: torch.Tensor, padding=None):
-        pretrained_indices = torch.gather(self.vocab_to_pretrained, dim=0, index=input)
-        rnn_output = self.model(pretrained_indices)
+        if self.vocab_to_pretrained.device != input.device:
+            self.vocab_to_pretrained = self.vocab_to_pretrained.to(input.device)
+        pretrained_indices = self.vocab_to_pretrained[input]
+
+        # the pretrained LM is time-major
+        rnn_output, _hidden = self.model.encode(pretrained_indices.transpose(0, 1))
+        rnn_output = rnn_output.transpose(0, 1)
         return EmbeddingOutput(all_layers=[rnn_output], last_layer=rnn_output)
 
 def _name_to_vector(emb_name, cachedir):
@@ -182,101 +424,100 @@ def get_embedding_type(emb_name):
         return emb_name
     
 
-def load_embeddings(cachedir, context_emb_names, question_emb_names, decoder_emb_names,
-                    max_generative_vocab=50000, logger=_logger, cache_only=False):
-    logger.info(f'Getting pretrained word vectors and pretrained models')
+def _make_output_cache(output_cache, max_memory_bytes):
+    if output_cache is None:
+        return None
+    elif output_cache == 'memory':
+        return EmbeddingOutputCache(max_memory_bytes=max_memory_bytes)
+    else:
+        return EmbeddingOutputCache(output_cache)
 
-    context_emb_names = context_emb_names.split('+')
-    question_emb_names = question_emb_names.split('+')
-    decoder_emb_names = decoder_emb_names.split('+')
 
-    all_vectors = {}
-    context_vectors = []
-    question_vectors = []
-    decoder_vectors = []
+def _load_transformer(emb_type, cachedir, cache_only):
+    config = AutoConfig.from_pretrained(emb_type, cache_dir=cachedir)
+    config.output_hidden_states = True
 
-    numericalizer = None
-    numericalizer_type = None
-    for emb_name in context_emb_names:
-        if not emb_name:
-            continue
-        if emb_name in all_vectors:
-            context_vectors.append(all_vectors[emb_name])
-            continue
+    if cache_only:
+        # load the tokenizer once to ensure all files are downloaded
+        # (otherwise, the numericalizer will load the tokenizer when building the vocabulary)
+        AutoTokenizer.from_pretrained(emb_type, cache_dir=cachedir)
 
-        emb_type = get_embedding_type(emb_name)
-        if emb_type in EMBEDDING_NAME_TO_NUMERICALIZER_MAP:
-            if numericalizer is not None and numericalizer_type != emb_type and not cache_only:
-                raise ValueError('Cannot specify multiple Transformer embeddings')
-
-            config = AutoConfig.from_pretrained(emb_type, cache_dir=cachedir)
-            config.output_hidden_states = True
-            if numericalizer is None:
-                numericalizer = EMBEDDING_NAME_TO_NUMERICALIZER_MAP[emb_type](emb_type, config=config,
-                                                  max_generative_vocab=max_generative_vocab,
-                                                  cache=cachedir)
-                numericalizer_type = emb_type
-
-            # load the tokenizer once to ensure all files are downloaded
-            AutoTokenizer.from_pretrained(emb_type, cache_dir=cachedir)
-
-            context_vectors.append(
-                TransformerEmbedding(AutoModel.from_pretrained(emb_type, config=config, cache_dir=cachedir)))
-        else:
-            if numericalizer is not None:
-                logger.warning('Combining Transformer embeddings with other pretrained embeddings is unlikely to work')
-            vec = _name_to_vector(emb_type, cachedir)
-            all_vectors[emb_name] = vec
-            context_vectors.append(vec)
-
-    for emb_name in question_emb_names:
-        if not emb_name:
-            continue
-        if emb_name in all_vectors:
-            question_vectors.append(all_vectors[emb_name])
-            continue
+    return config, AutoModel.from_pretrained(emb_type, config=config, cache_dir=cachedir)
+
+
+def load_embeddings(cachedir, context_emb_names, question_emb_names, decoder_emb_names,
+                    max_generative_vocab=50000, logger=_logger, cache_only=False, output_cache=None,
+                    output_cache_max_memory=4 * 1024 ** 3, tie_transformer_embeddings=False):
+    logger.info(f'Getting pretrained word vectors and pretrained models')
 
+    context_emb_names = [emb_name for emb_name in context_emb_names.split('+') if emb_name]
+    question_emb_names = [emb_name for emb_name in question_emb_names.split('+') if emb_name]
+    decoder_emb_names = [emb_name for emb_name in decoder_emb_names.split('+') if emb_name]
+
+    # first, find all the distinct embeddings we need to load
+    transformer_types = []
+    vector_names = []
+    for emb_name in context_emb_names + question_emb_names:
         emb_type = get_embedding_type(emb_name)
         if emb_type in EMBEDDING_NAME_TO_NUMERICALIZER_MAP:
-            if numericalizer is not None and numericalizer_type != emb_type:
-                raise ValueError('Cannot specify multiple Transformer embeddings')
-
-            config = AutoConfig.from_pretrained(emb_type, cache_dir=cachedir)
-            config.output_hidden_states = True
-            if numericalizer is None:
-                numericalizer = EMBEDDING_NAME_TO_NUMERICALIZER_MAP[emb_type](emb_type, config=config,
-                                                  max_generative_vocab=max_generative_vocab,
-                                                  cache=cachedir)
-
-                numericalizer_type = emb_type
-
-            # load the tokenizer once to ensure all files are downloaded
-            AutoTokenizer.from_pretrained(emb_type, cache_dir=cachedir)
-
-            question_vectors.append(
-                TransformerEmbedding(AutoModel.from_pretrained(emb_type, config=config, cache_dir=cachedir)))
-        else:
-            if numericalizer is not None:
-                logger.warning('Combining Transformer embeddings with other pretrained embeddings is unlikely to work')
-            vec = _name_to_vector(emb_type, cachedir)
-            all_vectors[emb_name] = vec
-            question_vectors.append(vec)
+            if emb_type not in transformer_types:
+                transformer_types.append(emb_type)
+        elif emb_name not in vector_names:
+            vector_names.append(emb_name)
+    if len(transformer_types) > 1 and not cache_only:
+        raise ValueError('Cannot specify multiple Transformer embeddings')
+    if transformer_types and vector_names:
+        logger.warning('Combining Transformer embeddings with other pretrained embeddings is unlikely to work')
 
     for emb_name in decoder_emb_names:
-        if not emb_name:
-            continue
-        emb_type = get_embedding_type(emb_name)
-        if emb_name in EMBEDDING_NAME_TO_NUMERICALIZER_MAP:
+        if get_embedding_type(emb_name) in EMBEDDING_NAME_TO_NUMERICALIZER_MAP:
             raise ValueError('Transformer embeddings cannot be specified in the decoder')
-
+        if emb_name not in vector_names:
+            vector_names.append(emb_name)
+
+    # loading is dominated by downloading, reading and deserializing files, so we load
+    # all the embeddings concurrently
+    with ThreadPoolExecutor(max_workers=max(1, len(transformer_types) + len(vector_names))) as executor:
+        transformer_futures = {emb_type: executor.submit(_load_transformer, emb_type, cachedir, cache_only)
+                               for emb_type in transformer_types}
+        vector_futures = {emb_name: executor.submit(_name_to_vector, get_embedding_type(emb_name), cachedir)
+                          for emb_name in vector_names}
+        pretrained_models = {emb_type: future.result() for emb_type, future in transformer_futures.items()}
+        # word vectors with the same name (including the @N suffix) share the same instance, and thus the same weights
+        all_vectors = {emb_name: future.result() for emb_name, future in vector_futures.items()}
+
+    # Transformer models are loaded once, but each use is an untied copy, unless tie_transformer_embeddings is set,
+    # in which case Transformer embeddings with the same name also share the same instance
+    tied_transformers = {}
+    used_models = set()
+    def get_vector(emb_name):
         if emb_name in all_vectors:
-            decoder_vectors.append(all_vectors[emb_name])
-        else:
-            vec = _name_to_vector(emb_type, cachedir)
-            all_vectors[emb_name] = vec
-            decoder_vectors.append(vec)
+            return all_vectors[emb_name]
+        if emb_name in tied_transformers:
+            return tied_transformers[emb_name]
 
-    if numericalizer is None:
+        emb_type = get_embedding_type(emb_name)
+        _config, model = pretrained_models[emb_type]
+        if emb_type in used_models:
+            # an untied copy of a model we have already loaded
+            model = copy.deepcopy(model)
+        used_models.add(emb_type)
+        vec = TransformerEmbedding(model, output_cache=_make_output_cache(output_cache, output_cache_max_memory))
+        if tie_transformer_embeddings:
+            tied_transformers[emb_name] = vec
+        return vec
+
+    context_vectors = [get_vector(emb_name) for emb_name in context_emb_names]
+    question_vectors = [get_vector(emb_name) for emb_name in question_emb_names]
+    decoder_vectors = [get_vector(emb_name) for emb_name in decoder_emb_names]
+
+    if transformer_types:
+        numericalizer_type = transformer_types[0]
+        config, _model = pretrained_models[numericalizer_type]
+        numericalizer = EMBEDDING_NAME_TO_NUMERICALIZER_MAP[numericalizer_type](numericalizer_type, config=config,
+                                                                                max_generative_vocab=max_generative_vocab,
+                                                                                cache=cachedir)
+    else:
         numericalizer = SimpleNumericalizer(max_generative_vocab=max_generative_vocab, pad_first=False)
 
     return numericalizer, context_vectors, question_vectors, decoder_vectors
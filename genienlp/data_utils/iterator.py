@@ -42,14 +42,41 @@ class Iterator(torch.utils.data.IterableDataset):
                  shuffle=False,
                  repeat=False,
                  use_data_batch_fn=False,
-                 use_data_sort_key=False):
+                 use_data_sort_key=False,
+                 sort=False,
+                 rank=0,
+                 world_size=1,
+                 seed=None):
         # batch_size can be number of tokens or number of examples
         # the type is inferred from batch_size_fn
+        # if sort is True (and shuffle is False), examples are batched in sort_key order instead of dataset order;
+        # self.order then lists the dataset index of every example, in the order they are returned
+        # with world_size > 1, only every world_size-th batch (starting at rank) is returned, so that each
+        # distributed process trains on its own shard; all processes must then shuffle with the same seed
+        # the iterator shuffles with its own random generator (seeded from the global one if seed is None), so that
+        # its position can be saved with state_dict and restored with load_state_dict
+        # batch_size can be changed during training; it is used from the next epoch, or the next bucket
         
         self.dataset = dataset
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.repeat = repeat
+        self.rank = rank
+        self.world_size = world_size
+        self.random = random.Random(seed if seed is not None else random.getrandbits(64))
+
+        # position of the iterator: random state at the start of the current epoch, number of batches of the
+        # current epoch that were already returned (to any process), and number of batches since the beginning
+        self.epoch_random_state = None
+        self.epoch_position = 0
+        self.batch_idx = 0
+        self._resume_state = None
+        # batch sizes used so far in the current epoch (for the whole epoch, or for each bucket), and those used before
+        # resuming, which must be used again to form the same batches
+        self.epoch_batch_sizes = []
+        self._resumed_batch_sizes = []
+        # the batch size the last returned batch was formed with
+        self.last_batch_size = None
         
         # used for sentence_batching
         self.groups = getattr(dataset, 'groups', None)
@@ -65,17 +92,60 @@ class Iterator(torch.utils.data.IterableDataset):
         else:
             self.sort_key = context_answer_len
 
+        self.order = None
+        if sort and not shuffle:
+            examples = list(self.dataset)
+            self.order = sorted(range(len(examples)), key=lambda i: self.sort_key(examples[i]))
+
     def __len__(self):
         if self.repeat:
             raise NotImplementedError()
         else:
             return len(self.dataset)
 
+    def state_dict(self):
+        """
+        The position of the iterator. The random state at the start of the epoch determines the shuffled order
+        of the examples and of the buckets, so together with the position in the epoch, it identifies the next batch
+        """
+        return {'epoch_random_state': self.epoch_random_state, 'epoch_position': self.epoch_position,
+                'batch_idx': self.batch_idx, 'batch_size': self.batch_size,
+                'epoch_batch_sizes': list(self.epoch_batch_sizes)}
+
+    def load_state_dict(self, state_dict):
+        """
+        Make the next iteration resume from a position returned by state_dict()
+
+        The batches before that position are formed again (to know where the epoch was), but they are not returned,
+        so they are never numericalized. With distributed training, any process can resume from the position saved by
+        rank 0, because all processes return the same number of batches.
+        """
+        self._resume_state = state_dict
+        self.batch_size = state_dict.get('batch_size', self.batch_size)
+
     def __iter__(self) -> Batch:
+        # batches are counted across epochs, so the shards stay disjoint even when an epoch does not
+        # divide evenly among the processes
+        skip = 0
+        self.batch_idx = 0
+        first_batch_idx = 0
+        if self._resume_state is not None:
+            # the state of an iterator that had not started yet has no epoch to resume, so we start a fresh one
+            if self._resume_state['epoch_random_state'] is not None:
+                self.random.setstate(self._resume_state['epoch_random_state'])
+            skip = self._resume_state['epoch_position']
+            self.batch_idx = self._resume_state['batch_idx']
+            # the other processes have already returned their batch of the last group of world_size batches
+            first_batch_idx = -(-self.batch_idx // self.world_size) * self.world_size
+            self._resumed_batch_sizes = self._resume_state.get('epoch_batch_sizes', [])
+            self._resume_state = None
         while True:
+            self.epoch_random_state = self.random.getstate()
+            self.epoch_position = 0
+            self.epoch_batch_sizes = []
             if self.shuffle:
                 dataset = list(self.dataset)
-                random.shuffle(dataset)
+                self.random.shuffle(dataset)
             else:
                 dataset = self.dataset
 
@@ -84,15 +154,40 @@ class Iterator(torch.utils.data.IterableDataset):
                     batches = self._sentence_batching(dataset)
                 else:
                     batches = self._bucket_batching(dataset)
+            elif self.order is not None:
+                examples = list(dataset)
+                batches = self._batch([examples[i] for i in self.order], self._next_batch_size())
             else:
-                batches = self._batch(dataset, self.batch_size)
+                batches = self._batch(dataset, self._next_batch_size())
 
             for minibatch in batches:
-                yield minibatch
+                self.epoch_position += 1
+                if skip > 0:
+                    # already returned before resuming
+                    skip -= 1
+                    continue
+                is_own_batch = self.batch_idx % self.world_size == self.rank and self.batch_idx >= first_batch_idx
+                self.batch_idx += 1
+                if is_own_batch:
+                    self.last_batch_size = self.epoch_batch_sizes[-1]
+                    yield minibatch
 
+            self._resumed_batch_sizes = []
             if not self.repeat:
                 break
 
+    def _next_batch_size(self):
+        """
+        The batch size to form the next batches with (for the rest of the epoch, or for the next bucket)
+        """
+        idx = len(self.epoch_batch_sizes)
+        if idx < len(self._resumed_batch_sizes):
+            batch_size = self._resumed_batch_sizes[idx]
+        else:
+            batch_size = self.batch_size
+        self.epoch_batch_sizes.append(batch_size)
+        return batch_size
+
     def _batch(self, data, batch_size, fixed_size_only=False):
         """
         
@@ -136,11 +231,11 @@ class Iterator(torch.utils.data.IterableDataset):
         each chunk using sort_key, then batch these examples and shuffle the
         batches.
         """
-        for p in self._batch(data, self.batch_size * 100):
-            p_batch = self._batch(sorted(p, key=self.sort_key), self.batch_size)
+        for p in self._batch(data, self._next_batch_size() * 100):
+            p_batch = self._batch(sorted(p, key=self.sort_key), self._next_batch_size())
             if self.shuffle:
                 p_batch = list(p_batch)
-                random.shuffle(p_batch)
+                self.random.shuffle(p_batch)
             for b in p_batch:
                 yield b
                 
@@ -152,12 +247,13 @@ class Iterator(torch.utils.data.IterableDataset):
         Regroup and return the batch
         """
         dataset_sorted = sorted(data, key=self.sort_key)
-        for batch in self._batch(dataset_sorted, self.batch_size, fixed_size_only=True):
-            assert self.batch_size % self.groups == 0
+        batch_size = self._next_batch_size()
+        for batch in self._batch(dataset_sorted, batch_size, fixed_size_only=True):
+            assert batch_size % self.groups == 0
             
             if self.shuffle:
-                minibatches = [batch[i: i+self.groups] for i in range(0, self.batch_size, self.groups)]
-                random.shuffle(minibatches)
+                minibatches = [batch[i: i+self.groups] for i in range(0, batch_size, self.groups)]
+                self.random.shuffle(minibatches)
                 # shuffle samples within each minibatch too
                 # for minibatch in minibatches:
                 #     random.shuffle(minibatch)
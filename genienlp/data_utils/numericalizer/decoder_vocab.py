@@ -27,6 +27,8 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import torch
+
 
 class DecoderVocabulary(object):
     def __init__(self, words, full_vocab, pad_token, eos_token):
@@ -45,6 +47,8 @@ class DecoderVocabulary(object):
             self.eos_idx = -1
         self.oov_itos = []
         self.oov_stoi = dict()
+        # full vocabulary ids of itos, shared with all clones
+        self._full_ids = dict()
 
     def clone(self):
         new_subset = DecoderVocabulary(None, self.full_vocab, self.pad_token, self.eos_token)
@@ -52,6 +56,7 @@ class DecoderVocabulary(object):
         new_subset.stoi = self.stoi
         new_subset.pad_idx = self.stoi[self.pad_token]
         new_subset.eos_idx = self.stoi[self.eos_token]
+        new_subset._full_ids = self._full_ids
         return new_subset
 
     def __len__(self):
@@ -73,3 +78,17 @@ class DecoderVocabulary(object):
             return self.full_vocab.stoi[self.itos[lim_idx]]
         else:
             return self.full_vocab.stoi[self.oov_itos[lim_idx - len(self.itos)]]
+
+    def decode_tensor(self, device=None):
+        """
+        Returns a tensor that maps each limited id, including the OOV words added so far, to its full vocabulary id
+        """
+        if device not in self._full_ids:
+            self._full_ids[device] = torch.tensor([self.full_vocab.stoi[word] for word in self.itos],
+                                                  dtype=torch.long, device=device)
+        full_ids = self._full_ids[device]
+        if not self.oov_itos:
+            return full_ids
+        oov_full_ids = torch.tensor([self.full_vocab.stoi[word] for word in self.oov_itos],
+                                    dtype=torch.long, device=device)
+        return torch.cat((full_ids, oov_full_ids), dim=0)
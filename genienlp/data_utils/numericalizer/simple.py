@@ -106,8 +106,12 @@ class SimpleNumericalizer(object):
         self.decoder_vocab = DecoderVocabulary(self.vocab.itos[:self.max_generative_vocab], self.vocab,
                                                pad_token=self.pad_token, eos_token=self.eos_token)
 
+    @property
+    def special_token_ids(self):
+        return (self.init_id, self.eos_id, self.pad_id, self.mask_id)
+
     def get_special_token_mask(self, tensor):
-        special_tokens_tuple = (self.init_id, self.eos_id, self.pad_id, self.mask_id)
+        special_tokens_tuple = self.special_token_ids
         return list(map(lambda x: 1 if x in special_tokens_tuple else 0, tensor))
 
 
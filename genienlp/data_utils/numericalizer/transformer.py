@@ -78,8 +78,13 @@ class TransformerNumericalizer(object):
         # return no new words - BertEmbedding will resize the embedding regardless
         return []
 
+    @property
+    def special_token_ids(self):
+        # tokenizers that do not define one of these tokens have a None id for it
+        return tuple(token_id for token_id in (self.init_id, self.eos_id, self.pad_id, self.mask_id) if token_id is not None)
+
     def get_special_token_mask(self, token_ids):
-        special_tokens_tuple = (self.init_id, self.eos_id, self.pad_id, self.mask_id)
+        special_tokens_tuple = self.special_token_ids
         return list(map(lambda x: 1 if x in special_tokens_tuple else 0, token_ids))
 
     def _init(self):
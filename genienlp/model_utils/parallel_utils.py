@@ -119,3 +119,8 @@ def scatter_kwargs(inputs, kwargs, target_gpus, dim=0):
 class NamedTupleCompatibleDataParallel(torch.nn.DataParallel):
     def scatter(self, inputs, kwargs, device_ids):
         return scatter_kwargs(inputs, kwargs, device_ids, dim=self.dim)
+
+
+class NamedTupleCompatibleDistributedDataParallel(torch.nn.parallel.DistributedDataParallel):
+    def scatter(self, inputs, kwargs, device_ids):
+        return scatter_kwargs(inputs, kwargs, device_ids, dim=self.dim)
@@ -36,16 +36,63 @@ import torch
 import json
 import os
 import logging
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
 
+def _snapshot(obj, pin_memory):
+    """
+    Copy all tensors in obj (a nested structure of dicts, lists and tuples) to CPU memory that training does not touch
+
+    Copies from the GPU go to pinned memory and do not wait for the device
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == 'cpu':
+            return obj.detach().clone()
+        buffer = torch.empty(obj.size(), dtype=obj.dtype, pin_memory=pin_memory)
+        buffer.copy_(obj.detach(), non_blocking=pin_memory)
+        return buffer
+    if isinstance(obj, dict):
+        return type(obj)((key, _snapshot(value, pin_memory)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(_snapshot(value, pin_memory) for value in obj)
+    return obj
+
+
+def _atomic_save(obj, filename):
+    tmp_filename = filename + '.tmp'
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def _atomic_link(src, dst):
+    """Make dst a hard link to src (or a copy of it, if the file system has no hard links), atomically"""
+    tmp_dst = dst + '.tmp'
+    if os.path.exists(tmp_dst):
+        os.unlink(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
 class Saver(object):
     '''
     Wrap pytorch's save functionality into an interface similar to tensorflow.train.Saver
     
     In particular, this class takes care of automatically cleaning up old checkpoints,
     and creating checkpoint files to keep track of which saves are valid and which are not.
+
+    Checkpoints are written by a background thread, from a CPU snapshot taken when save() is called, so training
+    can continue in the meantime. Every file is written under a temporary name and then renamed, so an interrupted
+    write never leaves a truncated checkpoint behind. At most one save is in flight: save() waits for the previous
+    one, and close() waits for the last one.
+
+    checkpoint.json also records the iteration and score of the best checkpoint, because with background validation
+    the best checkpoint is chosen after it is saved, so the score stored inside it is out of date.
     '''
 
     def __init__(self, savedir, max_to_keep=5):
@@ -56,6 +103,10 @@ class Saver(object):
         self._loaded_last_checkpoints = False
         self._latest_checkpoint = None
         self._all_checkpoints = None
+        self._best = None
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
 
     def _maybe_load_last_checkpoints(self):
         if self._loaded_last_checkpoints:
@@ -67,28 +118,100 @@ class Saver(object):
                 self._loaded_last_checkpoints = True
                 self._all_checkpoints = data['all']
                 self._latest_checkpoint = data['latest']
+                self._best = data.get('best')
         except FileNotFoundError:
             self._loaded_last_checkpoints = True
             self._all_checkpoints = []
             self._latest_checkpoint = None
 
-    def save(self, save_model_state_dict, save_opt_state_dict, global_step):
+    def best_decascore(self):
+        """The score of the best checkpoint recorded in checkpoint.json, or None"""
         self._maybe_load_last_checkpoints()
+        return self._best['decascore'] if self._best is not None else None
+
+    def _checkpoint_data(self):
+        return dict(all=list(self._all_checkpoints), latest=self._latest_checkpoint, best=self._best)
+
+    def wait(self):
+        """Wait until the last checkpoint is written; errors while writing it are raised here"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def save(self, save_model_state_dict, save_opt_state_dict, global_step, best=False, decascore=None):
+        """
+        Save a checkpoint for global_step; if best is True, also make it best.pth and best_optim.pth, with score decascore
+        """
+        self.wait()
+        self._maybe_load_last_checkpoints()
+
+        pin_memory = torch.cuda.is_available()
+        save_model_state_dict = _snapshot(save_model_state_dict, pin_memory)
+        save_opt_state_dict = _snapshot(save_opt_state_dict, pin_memory)
+        copied = None
+        if pin_memory:
+            # the writer thread waits for the copies from the GPU, the training thread does not
+            copied = torch.cuda.Event()
+            copied.record()
 
         model_name = 'iteration_' + str(global_step) + '.pth'
         opt_name = 'iteration_' + str(global_step) + '_optim.pth'
 
+        todelete = None
         self._latest_checkpoint = model_name
         self._all_checkpoints.append(model_name)
         if len(self._all_checkpoints) > self._max_to_keep:
+            todelete = self._all_checkpoints.pop(0)
+        if best:
+            self._best = dict(iteration=global_step, decascore=decascore)
+        checkpoint_data = self._checkpoint_data()
+
+        self._pending = self._executor.submit(self._write, save_model_state_dict, save_opt_state_dict, copied,
+                                              model_name, opt_name, todelete, checkpoint_data, best)
+
+    def _write(self, save_model_state_dict, save_opt_state_dict, copied, model_name, opt_name, todelete,
+               checkpoint_data, best):
+        if copied is not None:
+            copied.synchronize()
+        if todelete is not None:
             try:
-                todelete = self._all_checkpoints.pop(0)
                 os.unlink(os.path.join(self._savedir, todelete))
                 opt_todelete = todelete.rsplit('.', 1)[0] + '_optim.' + todelete.rsplit('.', 1)[1]
                 os.unlink(os.path.join(self._savedir, opt_todelete))
             except (OSError, IOError) as e:
                 logging.warning('Failed to delete old checkpoint: %s', e)
-        torch.save(save_model_state_dict, os.path.join(self._savedir, model_name))
-        torch.save(save_opt_state_dict, os.path.join(self._savedir, opt_name))
-        with open(os.path.join(self._savedir, 'checkpoint.json'), 'w') as fp:
-            json.dump(dict(all=self._all_checkpoints, latest=self._latest_checkpoint), fp)
+        _atomic_save(save_model_state_dict, os.path.join(self._savedir, model_name))
+        _atomic_save(save_opt_state_dict, os.path.join(self._savedir, opt_name))
+        if best:
+            # the best checkpoint is the one we just wrote, there is no need to serialize it again
+            self._link_best(model_name, opt_name)
+        self._write_checkpoint_data(checkpoint_data)
+
+    def _write_checkpoint_data(self, checkpoint_data):
+        tmp_filename = os.path.join(self._savedir, 'checkpoint.json.tmp')
+        with open(tmp_filename, 'w') as fp:
+            json.dump(checkpoint_data, fp)
+        os.replace(tmp_filename, os.path.join(self._savedir, 'checkpoint.json'))
+
+    def mark_best(self, global_step, decascore):
+        """
+        Make the (already saved, and not yet deleted) checkpoint for global_step the best one, with score decascore
+        """
+        self.wait()
+        self._maybe_load_last_checkpoints()
+        model_name = 'iteration_' + str(global_step) + '.pth'
+        opt_name = 'iteration_' + str(global_step) + '_optim.pth'
+        self._best = dict(iteration=global_step, decascore=decascore)
+        self._pending = self._executor.submit(self._mark_best, model_name, opt_name, self._checkpoint_data())
+
+    def _mark_best(self, model_name, opt_name, checkpoint_data):
+        self._link_best(model_name, opt_name)
+        self._write_checkpoint_data(checkpoint_data)
+
+    def _link_best(self, model_name, opt_name):
+        _atomic_link(os.path.join(self._savedir, model_name), os.path.join(self._savedir, 'best.pth'))
+        _atomic_link(os.path.join(self._savedir, opt_name), os.path.join(self._savedir, 'best_optim.pth'))
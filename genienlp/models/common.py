@@ -38,6 +38,9 @@ from torch.jit import Final
 from torch.nn import functional as F
 from torch.nn.utils.rnn import pack_padded_sequence as pack
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
+from torch.utils.checkpoint import checkpoint
+
+from ..util import isin, mask_for_mlm, token_id_tensor
 
 
 class EmbeddingOutput(NamedTuple):
@@ -49,6 +52,21 @@ INF = 1e10
 EPSILON = 1e-10
 
 
+def maybe_checkpoint(enabled, function, *args):
+    """
+    Call `function(*args)`; if `enabled`, the intermediate activations of `function` are not kept for the backward pass,
+    and are recomputed (with the same dropout masks) when the gradients are computed.
+
+    Arguments must be passed positionally. Checkpointing is skipped when gradients are disabled, because there is no
+    backward pass to save memory for, and when no input requires gradients, because the checkpointed function
+    would then not propagate gradients to its own parameters.
+    """
+    if enabled and torch.is_grad_enabled() and \
+            any(isinstance(arg, torch.Tensor) and arg.requires_grad for arg in args):
+        return checkpoint(function, *args)
+    return function(*args)
+
+
 class MultiLSTMCell(nn.Module):
     def __init__(self, num_layers, input_size, rnn_size, dropout):
         super(MultiLSTMCell, self).__init__()
@@ -177,7 +195,15 @@ class MultiHead(nn.Module):
         self.n_heads = n_heads
 
     def forward(self, query, key, value, padding=None):
-        query, key, value = self.wq(query), self.wk(key), self.wv(value)
+        key, value = self.project_key_value(key, value)
+        return self.attend(query, key, value, padding=padding)
+
+    def project_key_value(self, key, value):
+        return self.wk(key), self.wv(value)
+
+    def attend(self, query, key, value, padding=None):
+        # key and value are already projected with project_key_value()
+        query = self.wq(query)
         query, key, value = (
             x.chunk(self.n_heads, -1) for x in (query, key, value))
         return torch.cat([self.attention(q, k, v, padding=padding)
@@ -218,12 +244,14 @@ class TransformerEncoder(nn.Module):
         self.layers = nn.ModuleList(
             [TransformerEncoderLayer(dimension, n_heads, hidden, dropout) for i in range(num_layers)])
         self.dropout = nn.Dropout(dropout)
+        # recompute the activations of each layer in the backward pass instead of storing them
+        self.checkpoint_activations = False
 
     def forward(self, x, padding=None):
         x = self.dropout(x)
         encoding = [x]
         for layer in self.layers:
-            x = layer(x, padding=padding)
+            x = maybe_checkpoint(self.checkpoint_activations, layer, x, padding)
             encoding.append(x)
         return encoding
 
@@ -250,6 +278,26 @@ class TransformerDecoderLayer(nn.Module):
         x = self.selfattn(x, selfattn_keys, selfattn_keys, padding=answer_padding)
         return self.feedforward(self.attention(x, encoding, encoding, padding=context_padding))
 
+    def forward_step(self, x, encoding, selfattn_cache=None, context_padding=None):
+        """
+        Decode one step for multiple hypotheses of each input at once.
+
+        x is batch x hypotheses x dimension, and encoding and context_padding are shared among the hypotheses
+        of the same input. selfattn_cache holds the projected self-attention keys and values of the previous steps,
+        each (batch * hypotheses) x time x dimension, or is None at the first step.
+        Returns the output of this layer and the updated cache.
+        """
+        batch_size, num_hypotheses, dimension = x.size()
+        x = x.view(-1, dimension)
+        selfattn = self.selfattn.layer
+        key, value = selfattn.project_key_value(x.unsqueeze(1), x.unsqueeze(1))
+        if selfattn_cache is not None:
+            key = torch.cat((selfattn_cache[0], key), dim=1)
+            value = torch.cat((selfattn_cache[1], value), dim=1)
+        x = self.selfattn.layernorm(x + self.selfattn.dropout(selfattn.attend(x, key, value)))
+        x = self.attention(x.view(batch_size, num_hypotheses, dimension), encoding, encoding, padding=context_padding)
+        return self.feedforward(x), (key, value)
+
 
 class TransformerDecoder(nn.Module):
 
@@ -259,13 +307,15 @@ class TransformerDecoder(nn.Module):
             [TransformerDecoderLayer(dimension, n_heads, hidden, dropout, causal=causal) for i in range(num_layers)])
         self.dropout = nn.Dropout(dropout)
         self.d_model = dimension
+        # recompute the activations of each layer in the backward pass instead of storing them
+        self.checkpoint_activations = False
 
     def forward(self, x, encoding, context_padding=None, positional_encodings=True, answer_padding=None):
         if positional_encodings:
             x = x + positional_encodings_like(x)
         x = self.dropout(x)
         for layer, enc in zip(self.layers, encoding[1:]):
-            x = layer(x, enc, context_padding=context_padding, answer_padding=answer_padding)
+            x = maybe_checkpoint(self.checkpoint_activations, layer, x, enc, None, context_padding, answer_padding)
         return x
 
 
@@ -319,8 +369,13 @@ class LinearFeedforward(nn.Module):
 class PackedLSTM(nn.Module):
 
     def __init__(self, d_in, d_out, bidirectional=False, num_layers=1,
-                 dropout=0.0, batch_first=True):
-        """A wrapper class that packs input sequences and unpacks output sequences"""
+                 dropout=0.0, batch_first=True, max_unpacked_batch_size=4):
+        """A wrapper class that packs input sequences and unpacks output sequences
+
+        Packing is skipped when it is not needed: when all sequences have the same length, and for batches of
+        at most max_unpacked_batch_size sequences, which are run one at a time
+        (see benchmarks/packed_lstm.py for how to choose it)
+        """
         super().__init__()
         if bidirectional:
             d_out = d_out // 2
@@ -330,18 +385,39 @@ class PackedLSTM(nn.Module):
                            bidirectional=bidirectional,
                            batch_first=batch_first)
         self.batch_first = batch_first
+        self.max_unpacked_batch_size = max_unpacked_batch_size
 
     def forward(self, inputs, lengths, hidden=None):
-        lens, indices = torch.sort(lengths.clone().detach(), 0, True)
-        inputs = inputs[indices] if self.batch_first else inputs[:, indices]
-        outputs, (h, c) = self.rnn(pack(inputs, lens.tolist(),
-                                        batch_first=self.batch_first), hidden)
+        lens = lengths.tolist()
+        time_dim = 1 if self.batch_first else 0
+        if min(lens) == max(lens):
+            # there is no padding, so there is nothing to pack
+            return self.rnn(inputs.narrow(time_dim, 0, lens[0]), hidden)
+        if len(lens) <= self.max_unpacked_batch_size:
+            return self._forward_each(inputs, lens, hidden)
+
+        outputs, (h, c) = self.rnn(pack(inputs, lens, batch_first=self.batch_first, enforce_sorted=False), hidden)
         outputs = unpack(outputs, batch_first=self.batch_first)[0]
-        _, _indices = torch.sort(indices, 0)
-        outputs = outputs[_indices] if self.batch_first else outputs[:, _indices]
-        h, c = h[:, _indices, :], c[:, _indices, :]
         return outputs, (h, c)
 
+    def _forward_each(self, inputs, lens, hidden=None):
+        # run each sequence without its padding; outputs are padded with zeros, like unpack() does
+        batch_dim, time_dim = (0, 1) if self.batch_first else (1, 0)
+        max_len = max(lens)
+        outputs, hs, cs = [], [], []
+        for i, length in enumerate(lens):
+            example = inputs.narrow(batch_dim, i, 1).narrow(time_dim, 0, length)
+            example_hidden = None if hidden is None else tuple(x.narrow(1, i, 1) for x in hidden)
+            output, (h, c) = self.rnn(example, example_hidden)
+            if length < max_len:
+                padding_size = list(output.size())
+                padding_size[time_dim] = max_len - length
+                output = torch.cat((output, output.new_zeros(padding_size)), dim=time_dim)
+            outputs.append(output)
+            hs.append(h)
+            cs.append(c)
+        return torch.cat(outputs, dim=batch_dim), (torch.cat(hs, dim=1), torch.cat(cs, dim=1))
+
 
 class Linear(nn.Linear):
 
@@ -504,8 +580,14 @@ class CoattentiveLayer(nn.Module):
         self.proj = Feedforward(d, d, dropout=0.0)
         self.embed_sentinel = nn.Embedding(2, d)
         self.dropout = nn.Dropout(dropout)
+        # recompute the affinity and attention matrices in the backward pass instead of storing them
+        self.checkpoint_activations = False
 
     def forward(self, context, question, context_padding, question_padding):
+        return maybe_checkpoint(self.checkpoint_activations, self._coattend,
+                                context, question, context_padding, question_padding)
+
+    def _coattend(self, context, question, context_padding, question_padding):
         context_padding = torch.cat([context.new_zeros((context.size(0), 1), dtype=torch.bool), context_padding], 1)
         question_padding = torch.cat([question.new_zeros((question.size(0), 1), dtype=torch.bool), question_padding], 1)
 
@@ -562,27 +644,11 @@ def mask_tokens(inputs: torch.Tensor, numericalizer, probability):
 
     assert numericalizer.mask_id
 
-    labels = inputs.clone()
-    # We sample a few tokens in each sequence for masked-LM training
-    probability_matrix = torch.full(labels.shape, probability, device=inputs.device)
-    special_tokens_mask = [numericalizer.get_special_token_mask(token_ids) for token_ids in inputs.tolist()]
-    probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool, device=inputs.device),
-                                    value=0.0)
-    padding_mask = labels.eq(numericalizer.pad_id)
-    probability_matrix.masked_fill_(padding_mask, value=0.0)
-    masked_indices = torch.bernoulli(probability_matrix).bool()
+    # padding is one of the special tokens, so it is never masked
+    special_tokens_mask = isin(inputs, token_id_tensor(numericalizer.special_token_ids, inputs.device))
+    masked_inputs, masked_indices = mask_for_mlm(inputs, special_tokens_mask, numericalizer.mask_id,
+                                                 numericalizer.num_tokens, probability)
 
     # All tokens that are not masked become padding, so we don't compute loss on them
-    labels[~masked_indices] = numericalizer.pad_id
-
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8, device=inputs.device)).bool() & masked_indices
-    inputs[indices_replaced] = numericalizer.mask_id
-
-    # 10% of the time, we replace masked input tokens with random word
-    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5, device=inputs.device)).bool() & masked_indices & ~indices_replaced
-    random_words = torch.randint(numericalizer.num_tokens, labels.shape, dtype=torch.long, device=inputs.device)
-    inputs[indices_random] = random_words[indices_random]
-
-    # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-    return inputs, labels
+    labels = inputs.masked_fill(~masked_indices, numericalizer.pad_id)
+    return masked_inputs, labels
@@ -35,7 +35,9 @@ from .lstm_encoder import BiLSTMEncoder
 from .mqan_encoder import MQANEncoder
 from .identity_encoder import IdentityEncoder
 from .mqan_decoder import MQANDecoder
+from . import search
 from .common import mask_tokens
+from ..util import load_model_state_dict
 from transformers import PreTrainedModel, PretrainedConfig
 
 ENCODERS = {
@@ -61,7 +63,7 @@ class Seq2Seq(PreTrainedModel):
         decoder_embeddings = kwargs.pop("decoder_embeddings", None)
         save_dict = torch.load(args.best_checkpoint, map_location=device)
         model = Seq2Seq(numericalizer, args, context_embeddings, question_embeddings, decoder_embeddings)
-        model.load_state_dict(save_dict['model_state_dict'])
+        load_model_state_dict(model, save_dict['model_state_dict'])
         return model
 
     def __init__(self, numericalizer, args, context_embeddings, question_embeddings, decoder_embeddings):
@@ -74,6 +76,11 @@ class Seq2Seq(PreTrainedModel):
         if self.args.pretrain_context > 0:
             self.context_pretrain_lm_head = torch.nn.Linear(self.args.dimension, numericalizer.num_tokens)
 
+        if getattr(self.args, 'checkpoint_activations', False):
+            for module in self.modules():
+                if hasattr(module, 'checkpoint_activations'):
+                    module.checkpoint_activations = True
+
     def set_train_context_embeddings(self, trainable):
         self.encoder.set_train_context_embeddings(trainable)
 
@@ -94,29 +101,23 @@ class Seq2Seq(PreTrainedModel):
         loss = torch.nn.functional.cross_entropy(context_logits, masked_labels, ignore_index=self.numericalizer.pad_id)
         return (loss, )
 
-    def _normal_forward(self, batch, current_token_id, past=None, expansion_factor=1, generation_dict=None, encoder_output=None):
-        if encoder_output is None:
-            self_attended_context, final_context, context_rnn_state, final_question, question_rnn_state = self.encoder(batch)
-        else:
-            self_attended_context, final_context, context_rnn_state, final_question, question_rnn_state = encoder_output
+    def _normal_forward(self, batch):
+        self_attended_context, final_context, context_rnn_state, final_question, question_rnn_state = self.encoder(batch)
         encoder_loss = None
         if self.training and getattr(self.args, 'use_encoder_loss', None):
             encoder_loss = self.get_encoder_loss(context_rnn_state)
         return self.decoder(batch, self_attended_context, final_context, context_rnn_state,
-                            final_question, question_rnn_state, encoder_loss, current_token_id, decoder_wrapper=past,
-                            expansion_factor=expansion_factor, generation_dict=generation_dict)
+                            final_question, question_rnn_state, encoder_loss)
 
-    def forward(self, batch, pretraining=False, current_token_id=None, past=None,
-                expansion_factor=1, generation_dict=None, encoder_output=None):
+    def forward(self, batch, pretraining=False):
         """
-        When training or pretraining, forward() always returns a tuple where the first element is `loss`
+        forward() always returns a tuple where the first element is `loss`
         """
         if pretraining:
             return self._pretrain_forward(batch)
         else:
-            return self._normal_forward(batch, current_token_id, past, expansion_factor, generation_dict, encoder_output)
-        
-        
+            return self._normal_forward(batch)
+
     def get_encoder_loss(self, context_rnn_state):
         
         # concat hidden and cell state
@@ -145,17 +146,6 @@ class Seq2Seq(PreTrainedModel):
             
         return encoder_loss
         
-    def get_output_embeddings(self):
-        return self.decoder.decoder_embeddings
-
-    def prepare_inputs_for_generation(self, input_ids, past, attention_mask, use_cache, batch, generation_dict, encoder_output):
-        expansion_factor = input_ids.shape[0] // len(batch.example_id)
-        return {"batch": batch, "past": past, "current_token_id": input_ids[:,-1:], "expansion_factor": expansion_factor, "generation_dict": generation_dict, "encoder_output": encoder_output}
-
-    def _reorder_cache(self, past, beam_idx):
-        past.reorder(beam_idx)
-        return past
-
     def generate(self,
                  batch,
                  max_output_length,
@@ -166,47 +156,43 @@ class Seq2Seq(PreTrainedModel):
                  top_p,
                  num_beams,
                  no_repeat_ngram_size,
-                 do_sample
+                 do_sample,
+                 encoder_output=None,
+                 constraint=None
                  ):
-
-        encoder_output = self.encoder(batch)
-        self.config.vocab_size = len(batch.decoder_vocab)
-        self.config.is_encoder_decoder = False # in order to make it work with `transformers` generation code, we should treat this as a decoder-only model
-        batch_size = len(batch.example_id)
-        input_ids = torch.full((batch_size, 1), self.decoder.init_idx, dtype=torch.long, device=batch.context.value.device)
-        
-        generated = super().generate(input_ids=input_ids,
-                                     batch=batch,
-                                     max_length=max_output_length,
-                                     min_length=2, # generate at least one token after BOS
-                                     bos_token_id=self.decoder.init_idx,
-                                     pad_token_id=batch.decoder_vocab.pad_idx,
-                                     early_stopping=True,
-                                     num_return_sequences=num_outputs,
-                                     repetition_penalty=repetition_penalty,
-                                     temperature=temperature,
-                                     eos_token_id=batch.decoder_vocab.eos_idx,
-                                     top_k=top_k,
-                                     top_p=top_p,
-                                     num_beams=num_beams,
-                                     no_repeat_ngram_size=no_repeat_ngram_size,
-                                     do_sample=do_sample,
-                                     generation_dict={'max_output_length': max_output_length, 'num_beams': num_beams},
-                                     encoder_output=encoder_output
-                                    )
-        generated = torch.cat((generated[:, 0:1], generated[:, 1:].cpu().apply_(self.decoder.map_to_full).to(batch.context.value.device)), dim=1) # map everything to full vocabulary except BOS which already is in full vocabulary
-
-        return generated
-        
-
-    
-            
-        
-    
-    
-    
-    
-    
-    
-    
-    
+        """
+        encoder_output can be passed to reuse the output of self.encoder(batch) across calls;
+        constraint is an optional search.DecodingConstraint
+        """
+        if encoder_output is None:
+            encoder_output = self.encoder(batch)
+        self_attended_context, final_context, context_rnn_state, final_question, _question_rnn_state = encoder_output
+        decoder_state = self.decoder.decoder_wrapper(batch, self_attended_context, final_context, context_rnn_state,
+                                                     final_question, max_output_length)
+
+        device = batch.context.value.device
+        decoder_vocab = batch.decoder_vocab
+
+        full_ids = decoder_vocab.decode_tensor(device)
+
+        def map_to_full(token_ids):
+            return full_ids.index_select(0, token_ids.reshape(-1)).view(token_ids.size())
+
+        return search.generate(decoder_state,
+                               batch_size=len(batch.example_id),
+                               init_token_id=self.decoder.init_idx,
+                               eos_token_id=decoder_vocab.eos_idx,
+                               pad_token_id=decoder_vocab.pad_idx,
+                               map_to_full=map_to_full,
+                               device=device,
+                               max_length=max_output_length,
+                               min_length=2,  # generate at least one token after BOS
+                               num_outputs=num_outputs,
+                               num_beams=num_beams,
+                               do_sample=do_sample,
+                               temperature=temperature,
+                               top_k=top_k,
+                               top_p=top_p,
+                               repetition_penalty=repetition_penalty,
+                               no_repeat_ngram_size=no_repeat_ngram_size,
+                               constraint=constraint)
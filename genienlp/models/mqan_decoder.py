@@ -78,115 +78,118 @@ class MQANDecoder(nn.Module):
             self.decoder_embeddings.set_embeddings(embeddings)
 
     def forward(self, batch, self_attended_context, final_context, context_rnn_state, final_question,
-                question_rnn_state, encoder_loss, current_token_id=None, decoder_wrapper=None, expansion_factor=1, generation_dict=None):
+                question_rnn_state, encoder_loss):
 
         context, context_lengths, context_limited = batch.context.value, batch.context.length, batch.context.limited
         question, question_lengths, question_limited = batch.question.value, batch.question.length, batch.question.limited
         answer, answer_lengths, answer_limited = batch.answer.value, batch.answer.length, batch.answer.limited
         decoder_vocab = batch.decoder_vocab
-        self.map_to_full = decoder_vocab.decode
         context_padding = context.data == self.pad_idx
         question_padding = question.data == self.pad_idx
-        if self.training:
-            if self.args.rnn_layers > 0:
-                self.rnn_decoder.applyMasks(context_padding, question_padding)
-            else:
-                self.context_attn.applyMasks(context_padding)
-                self.question_attn.applyMasks(question_padding)
-
-            answer_padding = (answer.data == self.pad_idx)[:, :-1]
-
-            answer_embedded = self.decoder_embeddings(answer[:, :-1], padding=answer_padding).last_layer
-
-            if self.args.transformer_layers > 0:
-                self_attended_decoded = self.self_attentive_decoder(answer_embedded,
-                                                                    self_attended_context,
-                                                                    context_padding=context_padding,
-                                                                    answer_padding=answer_padding,
-                                                                    positional_encodings=True)
-            else:
-                self_attended_decoded = answer_embedded
 
-            if self.args.rnn_layers > 0:
-                rnn_decoder_outputs = self.rnn_decoder(self_attended_decoded, final_context, final_question,
-                                                        hidden=context_rnn_state)
-                decoder_output, vocab_pointer_switch_input, context_question_switch_input, context_attention, \
-                question_attention, rnn_state = rnn_decoder_outputs
-            else:
-                context_decoder_output, context_attention = self.context_attn(self_attended_decoded, final_context)
-                question_decoder_output, question_attention = self.question_attn(self_attended_decoded, final_question)
-
-                vocab_pointer_switch_input = torch.cat((context_decoder_output, self_attended_decoded), dim=-1)
-                context_question_switch_input = torch.cat((question_decoder_output, self_attended_decoded), dim=-1)
-
-                decoder_output = self.dropout(context_decoder_output)
+        if self.args.rnn_layers > 0:
+            self.rnn_decoder.applyMasks(context_padding, question_padding)
+        else:
+            self.context_attn.applyMasks(context_padding)
+            self.question_attn.applyMasks(question_padding)
 
-            vocab_pointer_switch = self.vocab_pointer_switch(vocab_pointer_switch_input)
-            context_question_switch = self.context_question_switch(context_question_switch_input)
+        answer_padding = (answer.data == self.pad_idx)[:, :-1]
 
-            probs = self.probs(decoder_output, vocab_pointer_switch, context_question_switch,
-                                context_attention, question_attention,
-                                context_limited, question_limited,
-                                decoder_vocab)
+        answer_embedded = self.decoder_embeddings(answer[:, :-1], padding=answer_padding).last_layer
 
-        
-            probs, targets = mask(answer_limited[:, 1:].contiguous(), probs.contiguous(), pad_idx=decoder_vocab.pad_idx)
-            loss = F.nll_loss(probs.log(), targets)
-            if encoder_loss is not None:
-                loss += self.args.encoder_loss_weight * encoder_loss
-            return (loss, )
+        if self.args.transformer_layers > 0:
+            self_attended_decoded = self.self_attentive_decoder(answer_embedded,
+                                                                self_attended_context,
+                                                                context_padding=context_padding,
+                                                                answer_padding=answer_padding,
+                                                                positional_encodings=True)
         else:
-            if decoder_wrapper is None:
-                decoder_wrapper = self.decoder_wrapper(self_attended_context, final_context, context_padding, final_question, question_padding,
-                                                    context_limited, question_limited, decoder_vocab, rnn_state=context_rnn_state,
-                                                    expansion_factor=expansion_factor, generation_dict=generation_dict)
-            else:
-                current_token_id = current_token_id.clone().cpu().apply_(self.map_to_full).to(current_token_id.device)
-            # (next_token_logits, past) where `past` includes all the states needed to continue generation
-            logits = torch.log(decoder_wrapper.next_token_probs(current_token_id))
-            return logits, decoder_wrapper
+            self_attended_decoded = answer_embedded
 
-    def probs(self, outputs, vocab_pointer_switches, context_question_switches,
-              context_attention, question_attention,
-              context_indices, question_indices,
-              decoder_vocab):
+        if self.args.rnn_layers > 0:
+            rnn_decoder_outputs = self.rnn_decoder(self_attended_decoded, final_context, final_question,
+                                                    hidden=context_rnn_state)
+            decoder_output, vocab_pointer_switch_input, context_question_switch_input, context_attention, \
+            question_attention, rnn_state = rnn_decoder_outputs
+        else:
+            context_decoder_output, context_attention = self.context_attn(self_attended_decoded, final_context)
+            question_decoder_output, question_attention = self.question_attn(self_attended_decoded, final_question)
 
-        size = list(outputs.size())
+            vocab_pointer_switch_input = torch.cat((context_decoder_output, self_attended_decoded), dim=-1)
+            context_question_switch_input = torch.cat((question_decoder_output, self_attended_decoded), dim=-1)
 
-        size[-1] = self.generative_vocab_size
-        scores = self.out(outputs.view(-1, outputs.size(-1))).view(size)
-        p_vocab = F.softmax(scores, dim=scores.dim() - 1)
-        scaled_p_vocab = vocab_pointer_switches.expand_as(p_vocab) * p_vocab
+            decoder_output = self.dropout(context_decoder_output)
 
-        effective_vocab_size = len(decoder_vocab)
-        if self.generative_vocab_size < effective_vocab_size:
-            size[-1] = effective_vocab_size - self.generative_vocab_size
-            buff = scaled_p_vocab.new_full(size, EPSILON)
-            scaled_p_vocab = torch.cat([scaled_p_vocab, buff], dim=buff.dim() - 1)
+        vocab_pointer_switch = self.vocab_pointer_switch(vocab_pointer_switch_input)
+        context_question_switch = self.context_question_switch(context_question_switch_input)
 
-        # p_context_ptr
-        scaled_p_vocab.scatter_add_(scaled_p_vocab.dim() - 1, context_indices.unsqueeze(1).expand_as(context_attention),
-                                    (context_question_switches * (1 - vocab_pointer_switches)).expand_as(
-                                        context_attention) * context_attention)
+        log_probs = self.log_probs(decoder_output, vocab_pointer_switch, context_question_switch,
+                                   context_attention, question_attention,
+                                   context_limited, question_limited,
+                                   decoder_vocab)
 
-        # p_question_ptr
-        scaled_p_vocab.scatter_add_(scaled_p_vocab.dim() - 1,
-                                    question_indices.unsqueeze(1).expand_as(question_attention),
-                                    ((1 - context_question_switches) * (1 - vocab_pointer_switches)).expand_as(
-                                        question_attention) * question_attention)
+        log_probs, targets = mask(answer_limited[:, 1:].contiguous(), log_probs.contiguous(), pad_idx=decoder_vocab.pad_idx)
+        loss = F.nll_loss(log_probs, targets)
+        if encoder_loss is not None:
+            loss += self.args.encoder_loss_weight * encoder_loss
+        return (loss, )
 
-        return scaled_p_vocab
+    def log_probs(self, outputs, vocab_pointer_switches, context_question_switches,
+                  context_attention, question_attention,
+                  context_indices, question_indices,
+                  decoder_vocab, out=None):
+        """
+        Log-probabilities of the pointer-generator mixture over the decoder vocabulary
 
-    def decoder_wrapper(self, self_attended_context, context, context_padding, question, question_padding, context_indices, question_indices,
-               decoder_vocab, rnn_state=None, expansion_factor=1, generation_dict=None):
-        batch_size = context.size()[0]
-        max_decoder_time = generation_dict['max_output_length']
+        The generative distribution is computed in log space, so tokens that are not pointed to never underflow.
+        `out` is an optional preallocated buffer for the result.
 
-        decoder_wrapper = MQANDecoderWrapper(self_attended_context, context, context_padding, question, question_padding, context_indices, question_indices,
-                                             decoder_vocab, rnn_state, batch_size, max_decoder_time,
-                                             self, num_beams=generation_dict['num_beams'], expansion_factor=expansion_factor)
-        
-        return decoder_wrapper
+        The mixture is always computed in float32, even if the inputs are float16 (with mixed precision training):
+        EPSILON is not representable in float16, and a float16 switch can round to exactly 0 or 1.
+        """
+        size = list(outputs.size())
+        size[-1] = len(decoder_vocab)
+        if out is None:
+            out = outputs.new_empty(size, dtype=torch.float)
+        vocab_pointer_switches = vocab_pointer_switches.float()
+        context_question_switches = context_question_switches.float()
+        context_attention = context_attention.float()
+        question_attention = question_attention.float()
+
+        scores = self.out(outputs.view(-1, outputs.size(-1))).view(*size[:-1], self.generative_vocab_size)
+        out[..., :self.generative_vocab_size] = F.log_softmax(scores.float(), dim=-1) + \
+            torch.log(vocab_pointer_switches.clamp(min=EPSILON))
+        # tokens outside the generative vocabulary can only be copied
+        out[..., self.generative_vocab_size:] = math.log(EPSILON)
+
+        # p_context_ptr and p_question_ptr, added together with a single scatter
+        pointer_switches = 1 - vocab_pointer_switches
+        pointer_indices = torch.cat((context_indices.unsqueeze(1).expand(*context_attention.size()),
+                                     question_indices.unsqueeze(1).expand(*question_attention.size())), dim=-1)
+        pointer_probs = torch.cat(((context_question_switches * pointer_switches) * context_attention,
+                                   ((1 - context_question_switches) * pointer_switches) * question_attention), dim=-1)
+        pointer = out.new_zeros(size).scatter_add_(out.dim() - 1, pointer_indices, pointer_probs)
+
+        # mix the generative and pointer probabilities of the tokens that are pointed to
+        if torch.is_grad_enabled():
+            # scatter_ would send the gradient of a token to every position that points to it,
+            # so we mix over the whole vocabulary instead
+            pointed = pointer > 0
+            return torch.where(pointed, torch.log(out.exp() + pointer.masked_fill(~pointed, 1)), out)
+        mixed = torch.log(out.gather(out.dim() - 1, pointer_indices).exp() +
+                          pointer.gather(out.dim() - 1, pointer_indices))
+        return out.scatter_(out.dim() - 1, pointer_indices, mixed)
+
+    def decoder_wrapper(self, batch, self_attended_context, final_context, context_rnn_state, final_question,
+                        max_decoder_time):
+        """
+        Start decoding the batch one token at a time, see MQANDecoderWrapper
+        """
+        context_padding = batch.context.value.data == self.pad_idx
+        question_padding = batch.question.value.data == self.pad_idx
+        return MQANDecoderWrapper(self_attended_context, final_context, context_padding, final_question,
+                                  question_padding, batch.context.limited, batch.question.limited, batch.decoder_vocab,
+                                  context_rnn_state, max_decoder_time, self)
 
 
 class LSTMDecoder(nn.Module):
@@ -210,7 +213,8 @@ class LSTMDecoder(nn.Module):
         self.question_attn.applyMasks(question_mask)
 
     def forward(self, input: torch.Tensor, context, question, output=None, hidden=None):
-        context_output = output if output is not None else self.make_init_output(context)
+        # one row per hypothesis, like input, while context may have a single row for all the hypotheses of an input
+        context_output = output if output is not None else self.make_init_output(input)
 
         context_outputs, vocab_pointer_switch_inputs, context_question_switch_inputs, context_attentions, question_attentions = [], [], [], [], []
         for decoder_input in input.split(1, dim=1):
@@ -224,8 +228,14 @@ class LSTMDecoder(nn.Module):
             dec_state, hidden = self.rnn(rnn_input, hidden)
             dec_state = dec_state.unsqueeze(1)
 
-            context_output, context_attention = self.context_attn(dec_state, context)
-            question_output, question_attention = self.question_attn(dec_state, question)
+            # when decoding, the hypotheses of the same input share one row of context and question
+            grouped_dec_state = dec_state.view(context.size(0), -1, dec_state.size(-1))
+            context_output, context_attention = self.context_attn(grouped_dec_state, context)
+            question_output, question_attention = self.question_attn(grouped_dec_state, question)
+            context_output = context_output.view(dec_state.size(0), 1, -1)
+            context_attention = context_attention.view(dec_state.size(0), 1, -1)
+            question_output = question_output.view(dec_state.size(0), 1, -1)
+            question_attention = question_attention.view(dec_state.size(0), 1, -1)
             vocab_pointer_switch_inputs.append(torch.cat([dec_state, context_output, decoder_input], -1))
             context_question_switch_inputs.append(torch.cat([dec_state, question_output, decoder_input], -1))
 
@@ -240,29 +250,25 @@ class LSTMDecoder(nn.Module):
                                               context_attentions,
                                               question_attentions)] + [hidden]
 
-    def make_init_output(self, context):
-        batch_size = context.size(0)
+    def make_init_output(self, input):
+        batch_size = input.size(0)
         h_size = (batch_size, 1, self.d_hid)
-        return context.new_zeros(h_size)
+        return input.new_zeros(h_size)
 
 
 class MQANDecoderWrapper(object):
     """
     A wrapper for MQANDecoder that wraps around its recurrent neural network, so that we can decode it like a Transformer
+
+    This is the decoder state used by the search algorithms in search.py. The encoder outputs are static during
+    decoding and are stored once per input. The recurrent state, the last decoder output and the self-attention
+    keys and values of each Transformer layer at the previous steps are dynamic and are stored once per hypothesis:
+    row `i` belongs to the input `i // num_hypotheses`.
     """
 
-    def __init__(self, self_attended_context, context, context_padding, question, question_padding, context_indices, question_indices,
-               decoder_vocab, rnn_state, batch_size, max_decoder_time, mqan_decoder: MQANDecoder, num_beams:int, expansion_factor:int):
+    def __init__(self, self_attended_context, context, context_padding, question, question_padding, context_indices,
+                 question_indices, decoder_vocab, rnn_state, max_decoder_time, mqan_decoder: MQANDecoder):
         self.decoder_vocab = decoder_vocab
-        self_attended_context = self.expand_for_beam_search(self_attended_context, batch_size, expansion_factor)
-        context = self.expand_for_beam_search(context, batch_size, expansion_factor)
-        context_padding = self.expand_for_beam_search(context_padding, batch_size, expansion_factor)
-        question = self.expand_for_beam_search(question, batch_size, expansion_factor)
-        question_padding = self.expand_for_beam_search(question_padding, batch_size, expansion_factor)
-        context_indices = self.expand_for_beam_search(context_indices, batch_size, expansion_factor)
-        question_indices = self.expand_for_beam_search(question_indices, batch_size, expansion_factor)
-        if rnn_state is not None:
-            rnn_state = self.expand_for_beam_search(rnn_state, batch_size, expansion_factor, dim=1)
         self.self_attended_context = self_attended_context
         self.context = context
         self.context_padding = context_padding
@@ -271,56 +277,77 @@ class MQANDecoderWrapper(object):
         self.context_indices = context_indices
         self.question_indices = question_indices
         self.rnn_state = rnn_state
-        self.batch_size = batch_size
         self.max_decoder_time = max_decoder_time
         self.mqan_decoder = mqan_decoder
-
-        if self.mqan_decoder.args.rnn_layers > 0:
-                self.mqan_decoder.rnn_decoder.applyMasks(self.context_padding, self.question_padding)
-        else:
-            self.mqan_decoder.context_attn.applyMasks(self.context_padding)
-            self.mqan_decoder.question_attn.applyMasks(self.question_padding)
+        self.apply_masks()
 
         self.time = 0
+        self.num_hypotheses = 1
         self.decoder_output = None
+        # reallocated whenever the number of rows changes
+        self.log_probs_buffer = None
 
+        # one (keys, values) pair per Transformer layer, once decoding starts
+        self.selfattn_cache = None
         if self.mqan_decoder.args.transformer_layers > 0:
-            self.hiddens = [self.self_attended_context[0].new_zeros((self.batch_size*expansion_factor, self.max_decoder_time, self.mqan_decoder.args.dimension))
-                    for l in range(len(self.mqan_decoder.self_attentive_decoder.layers) + 1)]
-            self.hiddens[0] =  self.hiddens[0] + positional_encodings_like(self.hiddens[0])
-
-    
-    def reorder(self, new_order):
-        # TODO only reordering rnn_state should be enough since reordering happens among beams of the same input
-        self.self_attended_context = self.reorder_for_beam_search(self.self_attended_context, new_order)
-        self.context = self.reorder_for_beam_search(self.context, new_order)
-        self.context_padding = self.reorder_for_beam_search(self.context_padding, new_order)
-        self.question = self.reorder_for_beam_search(self.question, new_order)
-        self.question_padding = self.reorder_for_beam_search(self.question_padding, new_order)
-        self.context_indices = self.reorder_for_beam_search(self.context_indices, new_order)
-        self.question_indices = self.reorder_for_beam_search(self.question_indices, new_order)
-        self.rnn_state = self.reorder_for_beam_search(self.rnn_state, new_order, dim=1)
+            self.positional_encodings = positional_encodings_like(
+                self.context.new_zeros((1, self.max_decoder_time, self.mqan_decoder.args.dimension)))
 
+    def apply_masks(self):
         if self.mqan_decoder.args.rnn_layers > 0:
-                self.mqan_decoder.rnn_decoder.applyMasks(self.context_padding, self.question_padding)
+            self.mqan_decoder.rnn_decoder.applyMasks(self.context_padding, self.question_padding)
         else:
             self.mqan_decoder.context_attn.applyMasks(self.context_padding)
             self.mqan_decoder.question_attn.applyMasks(self.question_padding)
 
-
-    def next_token_probs(self, current_token_id):
+    def expand(self, num_hypotheses):
+        new_order = torch.arange(self.context.size(0) * self.num_hypotheses, device=self.context.device)
+        self._reorder_dynamic(new_order.repeat_interleave(num_hypotheses))
+        self.num_hypotheses *= num_hypotheses
+        self.log_probs_buffer = None
+
+    def reorder(self, new_order, inputs=None):
+        self._reorder_dynamic(new_order)
+        if inputs is not None:
+            self.num_hypotheses = new_order.size(0) // inputs.size(0)
+            self.log_probs_buffer = None
+            self.self_attended_context = self.reorder_for_beam_search(self.self_attended_context, inputs)
+            self.context = self.reorder_for_beam_search(self.context, inputs)
+            self.context_padding = self.reorder_for_beam_search(self.context_padding, inputs)
+            self.question = self.reorder_for_beam_search(self.question, inputs)
+            self.question_padding = self.reorder_for_beam_search(self.question_padding, inputs)
+            self.context_indices = self.reorder_for_beam_search(self.context_indices, inputs)
+            self.question_indices = self.reorder_for_beam_search(self.question_indices, inputs)
+            self.apply_masks()
+
+    def _reorder_dynamic(self, new_order):
+        if self.rnn_state is not None:
+            self.rnn_state = self.reorder_for_beam_search(self.rnn_state, new_order, dim=1)
+        if self.decoder_output is not None:
+            self.decoder_output = self.reorder_for_beam_search(self.decoder_output, new_order)
+        if self.selfattn_cache is not None:
+            self.selfattn_cache = self.reorder_for_beam_search(self.selfattn_cache, new_order)
+
+    def _grouped(self, t):
+        # (batch * hypotheses) x 1 x ... -> batch x hypotheses x ...
+        return t.view(self.context.size(0), self.num_hypotheses, *t.shape[2:])
+
+    def next_token_log_probs(self, current_token_id):
         embedding = self.mqan_decoder.decoder_embeddings(current_token_id).last_layer
 
         if self.mqan_decoder.args.transformer_layers > 0:
-            self.hiddens[0][:, self.time] = self.hiddens[0][:, self.time] + \
-                                (math.sqrt(self.mqan_decoder.self_attentive_decoder.d_model) * embedding).squeeze(1)
-            for l in range(len(self.mqan_decoder.self_attentive_decoder.layers)):
-                self.hiddens[l + 1][:, self.time] = self.mqan_decoder.self_attentive_decoder.layers[l](self.hiddens[l][:, self.time],
-                                                                                self.self_attended_context[l],
-                                                                                selfattn_keys=self.hiddens[l][:, :self.time + 1],
-                                                                                context_padding=self.context_padding)
-
-            self_attended_decoded = self.hiddens[-1][:, self.time].unsqueeze(1)
+            layers = self.mqan_decoder.self_attentive_decoder.layers
+            hidden = self._grouped(self.positional_encodings[self.time] +
+                                   math.sqrt(self.mqan_decoder.self_attentive_decoder.d_model) * embedding)
+            selfattn_cache = []
+            for l in range(len(layers)):
+                hidden, layer_cache = layers[l].forward_step(hidden, self.self_attended_context[l],
+                    selfattn_cache=self.selfattn_cache[l] if self.selfattn_cache is not None else None,
+                    context_padding=self.context_padding)
+                selfattn_cache.append(layer_cache)
+            self.selfattn_cache = selfattn_cache
+
+            self_attended_decoded = hidden.view(-1, 1, hidden.size(-1))
         else:
             self_attended_decoded = embedding
 
@@ -330,8 +357,12 @@ class MQANDecoderWrapper(object):
             self.decoder_output, vocab_pointer_switch_input, context_question_switch_input, context_attention, \
                 question_attention, self.rnn_state = rnn_decoder_outputs
         else:
-            context_decoder_output, context_attention = self.mqan_decoder.context_attn(self_attended_decoded, self.context)
-            question_decoder_output, question_attention = self.mqan_decoder.question_attn(self_attended_decoded, self.question)
+            context_decoder_output, context_attention = self.mqan_decoder.context_attn(self._grouped(self_attended_decoded), self.context)
+            question_decoder_output, question_attention = self.mqan_decoder.question_attn(self._grouped(self_attended_decoded), self.question)
+            context_decoder_output = context_decoder_output.view(self_attended_decoded.size(0), 1, -1)
+            question_decoder_output = question_decoder_output.view(self_attended_decoded.size(0), 1, -1)
+            context_attention = context_attention.view(self_attended_decoded.size(0), 1, -1)
+            question_attention = question_attention.view(self_attended_decoded.size(0), 1, -1)
 
             vocab_pointer_switch_input = torch.cat((context_decoder_output, self_attended_decoded), dim=-1)
             context_question_switch_input = torch.cat((question_decoder_output, self_attended_decoded), dim=-1)
@@ -341,33 +372,19 @@ class MQANDecoderWrapper(object):
         vocab_pointer_switch = self.mqan_decoder.vocab_pointer_switch(vocab_pointer_switch_input)
         context_question_switch = self.mqan_decoder.context_question_switch(context_question_switch_input)
 
-        probs = self.mqan_decoder.probs(self.decoder_output, vocab_pointer_switch, context_question_switch,
-                            context_attention, question_attention,
-                            self.context_indices, self.question_indices, self.decoder_vocab)
+        # the pointer distributions are computed with all the hypotheses of the same input in one row,
+        # so they can share that input's context_indices and question_indices
+        if self.log_probs_buffer is None:
+            self.log_probs_buffer = self.context.new_empty((self.context.size(0), self.num_hypotheses,
+                                                            len(self.decoder_vocab)))
+        log_probs = self.mqan_decoder.log_probs(self._grouped(self.decoder_output), self._grouped(vocab_pointer_switch),
+                                                self._grouped(context_question_switch), self._grouped(context_attention),
+                                                self._grouped(question_attention), self.context_indices,
+                                                self.question_indices, self.decoder_vocab, out=self.log_probs_buffer)
 
         self.time += 1
-        return probs
-
-    def expand_for_beam_search(self, t, batch_size, num_beams, dim=0):
-        if isinstance(t, tuple):
-            elements = []
-            for e in t:
-                elements.append(self.expand_for_beam_search(e, batch_size, num_beams, dim))
-            return tuple(elements)
-        elif isinstance(t, list):
-            elements = []
-            for e in t:
-                elements.append(self.expand_for_beam_search(e, batch_size, num_beams, dim))
-            return elements
-
-        original_size = list(t.shape)
-        original_size[dim] *= num_beams
-        t = t.unsqueeze(dim+1)
-        expanded_size = list(t.shape)
-        expanded_size[dim+1] = num_beams
-        t = t.expand(*expanded_size)
-        t = t.contiguous().view(*original_size)  # (batch_size * num_beams, -1)
-        return t
+        # this is only valid until the next step, which reuses the buffer
+        return log_probs.view(-1, log_probs.size(-1))
 
     def reorder_for_beam_search(self, t, new_order, dim=0):
         if isinstance(t, tuple):
@@ -381,11 +398,4 @@ class MQANDecoderWrapper(object):
                 elements.append(self.reorder_for_beam_search(e, new_order, dim))
             return elements
 
-        p = [i for i in range(len(t.shape))]
-        p[dim] = 0
-        p[0] = dim
-        t = t.permute(*p)
-        t = t[new_order]
-        t = t.permute(*p)
-
-        return t
+        return t.index_select(dim, new_order)
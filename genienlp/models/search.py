@@ -0,0 +1,383 @@
+#
+# Copyright (c) 2020 The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Search algorithms (greedy decoding, sampling and beam search) for autoregressive decoders.
+
+The decoder is accessed through a decoder state object (such as MQANDecoderWrapper), which must implement:
+
+- `next_token_log_probs(current_token_id)`: consume one token per row (a `rows x 1` tensor of ids in the full
+  vocabulary), and return the `rows x vocab` log-probabilities of the next token, in the decoder vocabulary
+- `expand(num_hypotheses)`: give each row `num_hypotheses` identical copies, so each input can be decoded into
+  multiple beams or outputs
+- `reorder(new_order, inputs=None)`: rearrange the rows of the state; `new_order` only moves rows among the
+  hypotheses of the same input, unless `inputs` is given, in which case only the inputs at those positions are kept
+  (this is used to drop inputs that are done decoding)
+
+The tokens that can be generated at each step can be restricted with a DecodingConstraint.
+
+Rows that belong to the same input are always contiguous, and all inputs have the same number of rows, so
+the state can keep anything that does not depend on the hypothesis once per input.
+"""
+
+import torch
+from torch.nn import functional as F
+
+LENGTH_PENALTY = 1.0
+
+
+class DecodingConstraint(object):
+    """
+    A deterministic automaton over the decoder vocabulary that restricts which tokens can be generated
+
+    States must be hashable, so implementations can precompute the mask of each state once.
+    """
+
+    def initial_state(self):
+        raise NotImplementedError()
+
+    def next_state(self, state, token_id):
+        raise NotImplementedError()
+
+    def disallowed_tokens(self, state):
+        """
+        Returns a boolean tensor over the decoder vocabulary, on the decoding device,
+        that is True for the tokens that cannot follow `state`
+        """
+        raise NotImplementedError()
+
+
+class _ConstraintStates(object):
+    """
+    The state of a DecodingConstraint for each row
+    """
+
+    def __init__(self, constraint, num_rows):
+        self.constraint = constraint
+        self.states = [constraint.initial_state()] * num_rows
+
+    def apply(self, scores):
+        disallowed = torch.stack([self.constraint.disallowed_tokens(state) for state in self.states], dim=0)
+        return scores.masked_fill(disallowed, -float('inf'))
+
+    def advance(self, rows, token_ids):
+        self.states = [self.constraint.next_state(self.states[row], token_id) for row, token_id in zip(rows, token_ids)]
+
+
+class BeamHypotheses(object):
+    """
+    The `num_beams` best finished hypotheses for one input
+    """
+
+    def __init__(self, num_beams, length_penalty=LENGTH_PENALTY):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.beams = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def add(self, hyp, sum_logprobs):
+        score = sum_logprobs / len(hyp) ** self.length_penalty
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp))
+            if len(self) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self):
+        # we stop as soon as we have enough finished hypotheses (early stopping)
+        return len(self) >= self.num_beams
+
+    def best(self, n):
+        return [hyp for _score, hyp in sorted(self.beams, key=lambda x: x[0], reverse=True)[:n]]
+
+
+def top_k_top_p_filtering(logits, top_k=0, top_p=1.0, min_tokens_to_keep=1):
+    """
+    Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
+    """
+    if top_k > 0:
+        top_k = min(max(top_k, min_tokens_to_keep), logits.size(-1))
+        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+        logits = logits.masked_fill(indices_to_remove, -float('inf'))
+
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+
+        # remove tokens with cumulative probability above the threshold, but always keep at least
+        # min_tokens_to_keep tokens, and the first token above the threshold
+        sorted_indices_to_remove = cumulative_probs > top_p
+        if min_tokens_to_keep > 1:
+            sorted_indices_to_remove[..., :min_tokens_to_keep] = False
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = False
+
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        logits = logits.masked_fill(indices_to_remove, -float('inf'))
+    return logits
+
+
+def _banned_ngram_tokens(generated, no_repeat_ngram_size):
+    banned_tokens = []
+    for tokens in generated.tolist():
+        ngrams = dict()
+        for i in range(len(tokens) - no_repeat_ngram_size + 1):
+            prefix = tuple(tokens[i:i + no_repeat_ngram_size - 1])
+            ngrams.setdefault(prefix, []).append(tokens[i + no_repeat_ngram_size - 1])
+        current_prefix = tuple(tokens[len(tokens) - no_repeat_ngram_size + 1:])
+        banned_tokens.append(ngrams.get(current_prefix, []))
+    return banned_tokens
+
+
+def _postprocess_scores(scores, generated, cur_len, *, eos_token_id, min_length, repetition_penalty,
+                        no_repeat_ngram_size):
+    # the first column of generated is the BOS token, which is not in the decoder vocabulary
+    previous = generated[:, 1:]
+
+    if repetition_penalty != 1.0 and previous.size(1) > 0:
+        penalized = scores.gather(1, previous)
+        penalized = torch.where(penalized < 0, penalized * repetition_penalty, penalized / repetition_penalty)
+        scores = scores.scatter(1, previous, penalized)
+
+    if no_repeat_ngram_size > 0 and previous.size(1) + 1 >= no_repeat_ngram_size:
+        for i, banned in enumerate(_banned_ngram_tokens(previous, no_repeat_ngram_size)):
+            scores[i, banned] = -float('inf')
+
+    if cur_len < min_length:
+        scores[:, eos_token_id] = -float('inf')
+
+    return scores
+
+
+def _sample(decoder_state, *, batch_size, init_token_id, eos_token_id, pad_token_id, map_to_full, device,
+            max_length, min_length, num_outputs, do_sample, temperature, top_k, top_p, repetition_penalty,
+            no_repeat_ngram_size, constraint):
+    # greedy decoding always produces the same output for the same input, so we only decode each input once
+    expansion = num_outputs if do_sample else 1
+    if expansion > 1:
+        decoder_state.expand(expansion)
+    num_rows = batch_size * expansion
+
+    output = torch.full((num_rows, max_length), pad_token_id, dtype=torch.long, device=device)
+    output_length = max_length
+
+    # the rows of the inputs that are still being decoded, and where they go in the output
+    generated = torch.full((num_rows, 1), init_token_id, dtype=torch.long, device=device)
+    output_rows = torch.arange(num_rows, device=device)
+    current_token_id = generated
+    unfinished = torch.ones((num_rows,), dtype=torch.bool, device=device)
+    constraint_states = _ConstraintStates(constraint, num_rows) if constraint is not None else None
+    for cur_len in range(1, max_length):
+        scores = decoder_state.next_token_log_probs(current_token_id)
+        scores = _postprocess_scores(scores, generated, cur_len, eos_token_id=eos_token_id, min_length=min_length,
+                                     repetition_penalty=repetition_penalty, no_repeat_ngram_size=no_repeat_ngram_size)
+        if constraint_states is not None:
+            scores = constraint_states.apply(scores)
+
+        if do_sample:
+            if temperature != 1.0:
+                scores = scores / temperature
+            scores = top_k_top_p_filtering(scores, top_k=top_k, top_p=top_p)
+            next_token = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        else:
+            next_token = torch.argmax(scores, dim=-1)
+
+        # finished sequences are padded until all the outputs of the same input are finished
+        next_token = next_token.masked_fill(~unfinished, pad_token_id)
+        generated = torch.cat((generated, next_token.unsqueeze(1)), dim=1)
+        unfinished = unfinished & (next_token != eos_token_id)
+        if constraint_states is not None:
+            constraint_states.advance(range(next_token.size(0)), next_token.tolist())
+
+        unfinished_inputs = unfinished.view(-1, expansion).any(dim=1)
+        unfinished_input_list = unfinished_inputs.tolist()
+        if not all(unfinished_input_list):
+            # move the finished inputs to the output (the others will be overwritten when they finish),
+            # and drop them from the decoder state
+            output[output_rows, :cur_len + 1] = generated
+            if not any(unfinished_input_list):
+                output_length = cur_len + 1
+                break
+            kept_inputs = unfinished_inputs.nonzero().squeeze(1)
+            kept_rows = (kept_inputs.unsqueeze(1) * expansion + torch.arange(expansion, device=device)).view(-1)
+            decoder_state.reorder(kept_rows, inputs=kept_inputs)
+            generated = generated.index_select(0, kept_rows)
+            output_rows = output_rows.index_select(0, kept_rows)
+            unfinished = unfinished.index_select(0, kept_rows)
+            next_token = next_token.index_select(0, kept_rows)
+            if constraint_states is not None:
+                constraint_states.states = [constraint_states.states[row] for row in kept_rows.tolist()]
+        current_token_id = map_to_full(next_token.unsqueeze(1))
+    else:
+        # these inputs reached max_length
+        output[output_rows] = generated
+
+    generated = output[:, :output_length]
+    if expansion < num_outputs:
+        generated = generated.repeat_interleave(num_outputs // expansion, dim=0)
+    return generated
+
+
+def _beam_search(decoder_state, *, batch_size, init_token_id, eos_token_id, pad_token_id, map_to_full, device,
+                 max_length, min_length, num_outputs, num_beams, do_sample, temperature, top_k, top_p,
+                 repetition_penalty, no_repeat_ngram_size, constraint):
+    assert num_outputs <= num_beams, 'Beam search cannot return more outputs than beams'
+
+    # row i * num_beams + j of the state is beam j of the i-th input still being decoded
+    decoder_state.expand(num_beams)
+    generated = torch.full((batch_size * num_beams, 1), init_token_id, dtype=torch.long, device=device)
+    current_token_id = generated
+
+    # initially, all beams of an input are identical, so only the first one is used
+    beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=device)
+    beam_scores[:, 1:] = -1e9
+    beam_scores = beam_scores.view(-1)
+
+    hypotheses = [BeamHypotheses(num_beams) for _ in range(batch_size)]
+    active = list(range(batch_size))
+    constraint_states = _ConstraintStates(constraint, batch_size * num_beams) if constraint is not None else None
+    for cur_len in range(1, max_length):
+        scores = decoder_state.next_token_log_probs(current_token_id)
+        vocab_size = scores.size(-1)
+        scores = _postprocess_scores(scores, generated, cur_len, eos_token_id=eos_token_id, min_length=min_length,
+                                     repetition_penalty=repetition_penalty, no_repeat_ngram_size=no_repeat_ngram_size)
+        if constraint_states is not None:
+            scores = constraint_states.apply(scores)
+
+        # pick 2 * num_beams candidates for each input, so we have num_beams candidates even if all beams end
+        if do_sample:
+            scores = scores + beam_scores.unsqueeze(1)
+            if temperature != 1.0:
+                scores = scores / temperature
+            scores = top_k_top_p_filtering(scores, top_k=top_k, top_p=top_p, min_tokens_to_keep=2)
+            scores = scores.view(len(active), num_beams * vocab_size)
+            next_tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=2 * num_beams)
+            next_scores = torch.gather(scores, 1, next_tokens)
+            next_scores, next_scores_indices = torch.sort(next_scores, descending=True, dim=1)
+            next_tokens = torch.gather(next_tokens, 1, next_scores_indices)
+        else:
+            next_scores = (scores + beam_scores.unsqueeze(1)).view(len(active), num_beams * vocab_size)
+            next_scores, next_tokens = torch.topk(next_scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+
+        next_beam_rows = []
+        next_beam_tokens = []
+        next_beam_scores = []
+        still_active = []
+        kept_inputs = []
+        for i, (example_idx, example_tokens, example_scores) in \
+                enumerate(zip(active, next_tokens.tolist(), next_scores.tolist())):
+            hyps = hypotheses[example_idx]
+            num_candidates = 0
+            for rank, (beam_token_id, score) in enumerate(zip(example_tokens, example_scores)):
+                row = i * num_beams + beam_token_id // vocab_size
+                token_id = beam_token_id % vocab_size
+                if token_id == eos_token_id:
+                    # candidates beyond num_beams are only there to fill the beams, they cannot end
+                    if rank < num_beams:
+                        hyps.add(generated[row], score)
+                else:
+                    next_beam_rows.append(row)
+                    next_beam_tokens.append(token_id)
+                    next_beam_scores.append(score)
+                    num_candidates += 1
+                if num_candidates == num_beams:
+                    break
+
+            if hyps.is_done():
+                # drop this input from the search
+                del next_beam_rows[-num_candidates:]
+                del next_beam_tokens[-num_candidates:]
+                del next_beam_scores[-num_candidates:]
+            else:
+                still_active.append(example_idx)
+                kept_inputs.append(i)
+
+        if not still_active:
+            active = still_active
+            break
+
+        if constraint_states is not None:
+            constraint_states.advance(next_beam_rows, next_beam_tokens)
+        next_beam_rows = torch.tensor(next_beam_rows, dtype=torch.long, device=device)
+        next_beam_tokens = torch.tensor(next_beam_tokens, dtype=torch.long, device=device)
+        beam_scores = torch.tensor(next_beam_scores, dtype=torch.float, device=device)
+        generated = torch.cat((generated[next_beam_rows], next_beam_tokens.unsqueeze(1)), dim=1)
+        if len(still_active) == len(active):
+            # beams only moved within the same input
+            decoder_state.reorder(next_beam_rows)
+        else:
+            decoder_state.reorder(next_beam_rows, inputs=torch.tensor(kept_inputs, dtype=torch.long, device=device))
+        active = still_active
+        current_token_id = map_to_full(next_beam_tokens.unsqueeze(1))
+
+    # inputs that reached the maximum length without enough finished hypotheses use all their beams
+    beam_scores = beam_scores.tolist()
+    for i, example_idx in enumerate(active):
+        for beam_idx in range(num_beams):
+            row = i * num_beams + beam_idx
+            hypotheses[example_idx].add(generated[row], beam_scores[row])
+
+    best = [hyp for hyps in hypotheses for hyp in hyps.best(num_outputs)]
+    output_length = min(max(len(hyp) for hyp in best) + 1, max_length)
+    decoded = torch.full((len(best), output_length), pad_token_id, dtype=torch.long, device=device)
+    for i, hyp in enumerate(best):
+        decoded[i, :len(hyp)] = hyp
+        if len(hyp) < max_length:
+            decoded[i, len(hyp)] = eos_token_id
+    return decoded
+
+
+def generate(decoder_state, *, batch_size, init_token_id, eos_token_id, pad_token_id, map_to_full, device,
+             max_length, min_length=2, num_outputs=1, num_beams=1, do_sample=False, temperature=1.0,
+             top_k=0, top_p=1.0, repetition_penalty=1.0, no_repeat_ngram_size=0, constraint=None):
+    """
+    Decode from `decoder_state`, which holds `batch_size` rows (one per input).
+
+    Returns a `(batch_size * num_outputs) x length` tensor, where the outputs for the same input are contiguous.
+    The first column is `init_token_id`; the remaining tokens are mapped to the full vocabulary with `map_to_full`.
+    `max_length` and `min_length` include the initial token. `constraint` is an optional DecodingConstraint.
+    """
+    kwargs = dict(batch_size=batch_size, init_token_id=init_token_id, eos_token_id=eos_token_id,
+                  pad_token_id=pad_token_id, map_to_full=map_to_full, device=device,
+                  max_length=max_length, min_length=min_length, num_outputs=num_outputs, do_sample=do_sample,
+                  temperature=temperature, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty,
+                  no_repeat_ngram_size=no_repeat_ngram_size, constraint=constraint)
+    if num_beams > 1:
+        generated = _beam_search(decoder_state, num_beams=num_beams, **kwargs)
+    else:
+        generated = _sample(decoder_state, **kwargs)
+
+    # map everything to the full vocabulary, except the initial token, which is already in the full vocabulary
+    return torch.cat((generated[:, :1], map_to_full(generated[:, 1:])), dim=1)
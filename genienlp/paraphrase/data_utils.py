@@ -3,13 +3,12 @@ import re
 import random
 
 from tqdm import tqdm
-import torch
 import logging
 
 from ..util import detokenize, tokenize, lower_case, SpecialTokenMap
 
 from genienlp.paraphrase.dataset import TextDataset
-from genienlp.util import get_number_of_lines
+from genienlp.util import get_number_of_lines, isin, mask_for_mlm, token_id_tensor
 
 logger = logging.getLogger(__name__)
 
@@ -68,27 +67,28 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, aux=False):
     return dataset
 
 
+def _masked_special_ids(tokenizer):
+    """
+    The special token ids that tokenizer.get_special_tokens_mask(already_has_special_tokens=True) excludes from masking
+    (e.g. only CLS and SEP for BERT and RoBERTa, none for GPT-2); it decides token by token, so asking it once about
+    every special id gives the same mask as asking it about every sequence.
+    """
+    special_ids = tokenizer.all_special_ids
+    special_tokens_mask = tokenizer.get_special_tokens_mask(special_ids, already_has_special_tokens=True)
+    return tuple(token_id for token_id, is_special in zip(special_ids, special_tokens_mask) if is_special)
+
+
 def mask_tokens(inputs, labels, tokenizer, mlm_probability, mlm_ignore_index):
     """
     Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
+    Runs on the device of `inputs`, without copying them to the host.
     """
     # We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-    probability_matrix = torch.full(labels.shape, mlm_probability)
-    special_tokens_mask = [tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()]
-    probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
-    masked_indices = torch.bernoulli(probability_matrix).bool()
-    labels[~masked_indices] = mlm_ignore_index  # We only compute loss on masked tokens
-
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
-    inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
-
-    # 10% of the time, we replace masked input tokens with random word
-    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-    random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long)
-    inputs[indices_random] = random_words[indices_random]
-
-    # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+    special_tokens_mask = isin(labels, token_id_tensor(_masked_special_ids(tokenizer), labels.device))
+    inputs, masked_indices = mask_for_mlm(inputs, special_tokens_mask, tokenizer.mask_token_id, len(tokenizer),
+                                          mlm_probability)
+    labels = labels.masked_fill(~masked_indices, mlm_ignore_index)  # We only compute loss on masked tokens
+
     return inputs, labels
 
 
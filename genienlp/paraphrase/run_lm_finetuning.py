@@ -176,10 +176,10 @@ def train(args, train_dataset, model, tokenizer):
 
             inputs, labels, position_ids, segment_ids = batch # batch is a tuple (input, labels, position_ids, segment_ids)
             
-            if args.mlm:
-                inputs, labels = mask_tokens(inputs, labels, tokenizer, args.mlm_probability, args.mlm_ignore_index)
             inputs = inputs.to(args.device)
             labels = labels.to(args.device)
+            if args.mlm:
+                inputs, labels = mask_tokens(inputs, labels, tokenizer, args.mlm_probability, args.mlm_ignore_index)
             position_ids = position_ids.to(args.device)
             segment_ids = segment_ids.to(args.device)
             model.train()
@@ -321,10 +321,10 @@ def evaluate(args, model, tokenizer, prefix="", aux=False):
 
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         inputs, labels, position_ids, segment_ids = batch
-        if args.mlm:
-            inputs, labels = mask_tokens(inputs, labels, tokenizer, args.mlm_probability, args.mlm_ignore_index)
         inputs = inputs.to(args.device)
         labels = labels.to(args.device)
+        if args.mlm:
+            inputs, labels = mask_tokens(inputs, labels, tokenizer, args.mlm_probability, args.mlm_ignore_index)
         position_ids = position_ids.to(args.device)
         segment_ids = segment_ids.to(args.device)
 
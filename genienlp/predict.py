@@ -108,7 +108,7 @@ def prepare_data(args, numericalizer, embeddings):
 def run(args, device):
     numericalizer, context_embeddings, question_embeddings, decoder_embeddings = \
         load_embeddings(args.embeddings, args.context_embeddings, args.question_embeddings, args.decoder_embeddings,
-                        args.max_generative_vocab, logger)
+                        args.max_generative_vocab, logger, tie_transformer_embeddings=args.tie_transformer_embeddings)
     numericalizer.load(args.path)
     for emb in set(context_embeddings + question_embeddings + decoder_embeddings):
         emb.init_for_vocab(numericalizer.vocab)
@@ -139,13 +139,15 @@ def run(args, device):
             for index, set_ in enumerate(val_set):
                 loader = make_data_loader(set_, numericalizer, bs, device,
                                           append_question_to_context_too=args.append_question_to_context_too,
-                                          override_question=args.override_question, override_context=args.override_context)
+                                          override_question=args.override_question, override_context=args.override_context,
+                                          sort=True)
                 task_iter.append((task, task_languages[index], loader))
         # single language task or no separate eval
         else:
            loader = make_data_loader(val_set[0], numericalizer, bs, device,
                                      append_question_to_context_too=args.append_question_to_context_too,
-                                     override_question=args.override_question, override_context=args.override_context)
+                                     override_question=args.override_question, override_context=args.override_context,
+                                     sort=True)
            task_iter.append((task, task_languages, loader))
 
         iters.extend(task_iter)
@@ -183,7 +185,9 @@ def run(args, device):
                 else:
                     raise OSError(f'{results_file_name} already exists')
 
-            _, predictions, answers, contexts, _ = generate_with_model(model, it, numericalizer, task, args, prediction_file_name)
+            # batches are sorted by length, generate_with_model restores the order of the dataset
+            _, predictions, answers, contexts, _ = generate_with_model(model, it, numericalizer, task, args, prediction_file_name,
+                                                                       original_order=it.dataset.order)
             
             if len(answers) > 0:
                 metrics_to_compute = task.metrics
@@ -265,6 +269,11 @@ def parse_argv(parser):
     parser.add_argument("--top_p", type=float, nargs='+', default=[1.0], help='1.0 disables top-p filtering')
     parser.add_argument("--num_beams", type=int, nargs='+', default=[1], help='1 disables beam seach')
     parser.add_argument("--no_repeat_ngram_size", type=int, nargs='+', default=[0], help='ngrams of this size cannot be repeated in the output. 0 disables it.')
+    parser.add_argument('--thingtalk_constraints', action='store_true',
+                        help='Constrain the generated ThingTalk programs to be well formed (for Almond tasks)')
+    parser.add_argument('--thingtalk_functions', type=str, default=None,
+                        help='A JSON file mapping each ThingTalk function to its parameter names; with --thingtalk_constraints, '
+                             'only these functions and parameters can be generated')
 
 
 def adjust_multilingual_eval(args):
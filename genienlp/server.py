@@ -42,7 +42,7 @@ from .data_utils.embeddings import load_embeddings
 from .data_utils.example import Batch
 from .tasks.generic_dataset import Example
 from .tasks.registry import get_tasks
-from .util import set_seed, init_devices, load_config_json, log_model_size
+from .util import set_seed, init_devices, load_config_json, log_model_size, load_model_state_dict
 from .validate import generate_with_model
 
 logger = logging.getLogger(__name__)
@@ -156,6 +156,11 @@ def parse_argv(parser):
                         help='Checkpoint file to use (relative to --path, defaults to best.pth)')
     parser.add_argument('--port', default=8401, type=int, help='TCP port to listen on')
     parser.add_argument('--stdin', action='store_true', help='Interact on stdin/stdout instead of TCP')
+    parser.add_argument('--thingtalk_constraints', action='store_true',
+                        help='Constrain the generated ThingTalk programs to be well formed (for Almond tasks)')
+    parser.add_argument('--thingtalk_functions', type=str, default=None,
+                        help='A JSON file mapping each ThingTalk function to its parameter names; with --thingtalk_constraints, '
+                             'only these functions and parameters can be generated')
 
 
 def main(args):
@@ -170,7 +175,8 @@ def main(args):
 
     numericalizer, context_embeddings, question_embeddings, decoder_embeddings = \
         load_embeddings(args.embeddings, args.context_embeddings, args.question_embeddings,
-                        args.decoder_embeddings, args.max_generative_vocab)
+                        args.decoder_embeddings, args.max_generative_vocab,
+                        tie_transformer_embeddings=args.tie_transformer_embeddings)
     numericalizer.load(args.path)
     for emb in set(context_embeddings + question_embeddings + decoder_embeddings):
         emb.init_for_vocab(numericalizer.vocab)
@@ -179,9 +185,9 @@ def main(args):
     Model = getattr(models, args.model)
     model = Model(numericalizer, args, context_embeddings, question_embeddings, decoder_embeddings)
     model_dict = save_dict['model_state_dict']
-    model.load_state_dict(model_dict)
+    load_model_state_dict(model, model_dict)
 
-    server = Server(args, numericalizer, context_embeddings + question_embeddings + decoder_embeddings,
+    server = Server(args, numericalizer, set(context_embeddings + question_embeddings + decoder_embeddings),
                     model, devices[0])
 
     server.run()
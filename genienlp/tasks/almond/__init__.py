@@ -38,6 +38,7 @@ from ..registry import register_task
 from ..generic_dataset import CQA, context_answer_len, token_batch_fn, default_batch_fn
 from ...data_utils.example import Example
 from .utils import ISO_to_LANG, is_device, is_entity, process_id, is_cjk_char
+from .constraints import ThingTalkGrammar
 
 from ..base_dataset import Split
 
@@ -117,11 +118,19 @@ class BaseAlmondTask(BaseTask):
         super().__init__(name, args)
         self._preprocess_context = args.almond_preprocess_context
         self._almond_has_multiple_programs = args.almond_has_multiple_programs
+        self._thingtalk_grammar = None
+        if getattr(args, 'thingtalk_constraints', False):
+            self._thingtalk_grammar = ThingTalkGrammar.load(getattr(args, 'thingtalk_functions', None))
 
     @property
     def metrics(self):
         return ['em', 'sm', 'bleu']
 
+    def decoding_constraint(self, decoder_vocab, device=None):
+        if self._thingtalk_grammar is None or not self._is_program_field('answer'):
+            return None
+        return self._thingtalk_grammar.for_vocab(decoder_vocab, device)
+
     def _is_program_field(self, field_name):
         raise NotImplementedError()
 
@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2019, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import torch
+
+from ...models.search import DecodingConstraint
+from .utils import is_device
+
+
+def is_parameter(token):
+    return token.startswith('param:')
+
+
+def parameter_name(token):
+    # parameters are tokenized as param:<name>:<type>
+    return token.split(':')[1]
+
+
+class ThingTalkGrammar(object):
+    """
+    A coarse ThingTalk grammar used to constrain the decoding of programs:
+    quoted strings must be non-empty and closed before the end of the program, and, if the functions that can be
+    used are known, only those functions and, after the first function, only the parameters of the functions
+    generated so far can be generated (parameter passing and filters can refer to the output of earlier functions)
+
+    `functions` maps each function (e.g. @com.twitter.post) to the list of its parameter names,
+    or to None if its parameters are not known
+    """
+
+    def __init__(self, functions=None):
+        self.functions = functions
+        # analysis of the generative part of the decoder vocabulary, which is shared by all batches
+        self._vocab_itos = None
+        self._vocab_tokens = None
+
+    @staticmethod
+    def load(filename):
+        if filename is None:
+            return ThingTalkGrammar()
+        with open(filename) as fp:
+            functions = json.load(fp)
+        if isinstance(functions, list):
+            functions = {function: None for function in functions}
+        return ThingTalkGrammar({function: (set(params) if params is not None else None)
+                                 for function, params in functions.items()})
+
+    def for_vocab(self, decoder_vocab, device=None):
+        if self._vocab_itos is not decoder_vocab.itos:
+            self._vocab_itos = decoder_vocab.itos
+            self._vocab_tokens = _VocabularyTokens(decoder_vocab.itos)
+        oov_tokens = _VocabularyTokens(decoder_vocab.oov_itos, offset=len(decoder_vocab.itos))
+        return ThingTalkConstraint(self, decoder_vocab, self._vocab_tokens.merge(oov_tokens), device)
+
+
+class _VocabularyTokens(object):
+    """
+    The ids of the quote, function and parameter tokens in a list of words
+    """
+
+    def __init__(self, words=(), offset=0):
+        self.quote = []
+        self.functions = dict()
+        self.parameters = dict()
+        for idx, word in enumerate(words, start=offset):
+            if not word:
+                continue
+            if word == '"':
+                self.quote.append(idx)
+            elif is_device(word):
+                self.functions.setdefault(word, []).append(idx)
+            elif is_parameter(word):
+                self.parameters.setdefault(parameter_name(word), []).append(idx)
+
+    def merge(self, other):
+        merged = _VocabularyTokens()
+        merged.quote = self.quote + other.quote
+        for attr in ('functions', 'parameters'):
+            merged_dict = getattr(merged, attr)
+            for source in (getattr(self, attr), getattr(other, attr)):
+                for key, ids in source.items():
+                    merged_dict[key] = merged_dict.get(key, []) + ids
+        return merged
+
+
+class ThingTalkConstraint(DecodingConstraint):
+    """
+    ThingTalkGrammar applied to one batch
+
+    The state is (inside a quoted string, right after the opening quote, the functions generated so far).
+    """
+
+    def __init__(self, grammar, decoder_vocab, tokens, device):
+        self.grammar = grammar
+        self.decoder_vocab = decoder_vocab
+        self.tokens = tokens
+        self.device = device
+        self.quote_ids = set(tokens.quote)
+        self.function_ids = {idx: function for function, ids in tokens.functions.items() for idx in ids}
+        self._masks = dict()
+
+    def initial_state(self):
+        return False, False, frozenset()
+
+    def next_state(self, state, token_id):
+        in_quote, _just_opened, functions = state
+        if token_id in self.quote_ids:
+            return not in_quote, not in_quote, functions
+        if in_quote:
+            return True, False, functions
+        function = self.function_ids.get(token_id)
+        if function is not None and function not in functions:
+            functions = functions | {function}
+        return False, False, functions
+
+    def disallowed_tokens(self, state):
+        mask = self._masks.get(state)
+        if mask is None:
+            mask = self._masks[state] = self._make_mask(state).to(self.device)
+        return mask
+
+    def _make_mask(self, state):
+        in_quote, just_opened, seen_functions = state
+        mask = torch.zeros(len(self.decoder_vocab), dtype=torch.bool)
+        if in_quote:
+            # quotes must be closed before the end, and cannot be empty
+            mask[self.decoder_vocab.eos_idx] = True
+            if just_opened and self.tokens.quote:
+                mask[self.tokens.quote] = True
+            return mask
+
+        functions = self.grammar.functions
+        if functions is None:
+            return mask
+        for name, ids in self.tokens.functions.items():
+            if name not in functions:
+                mask[ids] = True
+        if not seen_functions or any(functions.get(function) is None for function in seen_functions):
+            return mask
+        allowed_parameters = set().union(*(functions[function] for function in seen_functions))
+        for name, ids in self.tokens.parameters.items():
+            if name not in allowed_parameters:
+                mask[ids] = True
+        return mask
@@ -72,6 +72,15 @@ class BaseTask:
         """
         return generic_dataset.JSON.splits(root=root, name=self.name, tokenize=self.tokenize, **kwargs)
 
+    def decoding_constraint(self, decoder_vocab, device=None):
+        """
+        Restrict the answers that can be generated for a batch
+
+        :param decoder_vocab: the decoder vocabulary of the batch
+        :return: a DecodingConstraint, or None if any answer can be generated
+        """
+        return None
+
     def preprocess_example(self, ex, train=False, max_context_length=None):
         """
         Preprocess a given example, in a task specific way.
@@ -29,11 +29,15 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import contextlib
+import datetime
 import logging
 import logging.handlers
 import math
 import os
+import queue
 import time
+import traceback
 from copy import deepcopy
 from functools import partial
 from pprint import pformat
@@ -44,25 +48,29 @@ from tensorboardX import SummaryWriter
 
 from . import arguments
 from . import models
-from .data_utils.embeddings import load_embeddings
-from .data_utils.example import Example
+from .data_utils.embeddings import load_embeddings, TransformerEmbedding
+from .data_utils.example import Example, Batch
 from .util import elapsed_time, set_seed, preprocess_examples, get_trainable_params, make_data_loader,\
-    log_model_size, init_devices
-from .model_utils.parallel_utils import NamedTupleCompatibleDataParallel
+    log_model_size, init_devices, load_model_state_dict
+from .model_utils.parallel_utils import NamedTupleCompatibleDataParallel, NamedTupleCompatibleDistributedDataParallel
 from .model_utils.saver import Saver
 from .validate import validate
 
 
-def initialize_logger(args):
-    # set up file logger
+def initialize_logger(args, rank=0):
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    handler = logging.handlers.RotatingFileHandler(os.path.join(args.log_dir, f'train.log'),
-                                                   maxBytes=1024 * 1024 * 10, backupCount=1)
-    handler.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(name)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    if rank == 0:
+        # set up file logger
+        logger.setLevel(logging.DEBUG)
+        handler = logging.handlers.RotatingFileHandler(os.path.join(args.log_dir, f'train.log'),
+                                                       maxBytes=1024 * 1024 * 10, backupCount=1)
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    else:
+        # the other distributed processes only report problems
+        logger.setLevel(logging.WARNING)
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
     handler.setLevel(logging.DEBUG)
@@ -72,7 +80,7 @@ def initialize_logger(args):
     return logger
 
 
-def prepare_data(args, logger):
+def prepare_data(args, logger, rank=0, world_size=1):
     train_sets, val_sets, aux_sets, vocab_sets = [], [], [], []
     for task in args.train_tasks:
         logger.info(f'Loading {task.name}')
@@ -121,14 +129,24 @@ def prepare_data(args, logger):
                         args.question_embeddings,
                         args.decoder_embeddings,
                         args.max_generative_vocab,
-                        logger)
+                        logger,
+                        output_cache=args.frozen_embeddings_cache,
+                        output_cache_max_memory=int(args.frozen_embeddings_cache_max_memory * 1024 ** 3),
+                        tie_transformer_embeddings=args.tie_transformer_embeddings)
     if args.load is not None:
         numericalizer.load(args.save)
     else:
-        vocab_sets = (train_sets + val_sets) if len(vocab_sets) == 0 else vocab_sets
-        logger.info(f'Building vocabulary')
-        numericalizer.build_vocab(Example.vocab_fields, vocab_sets)
-        numericalizer.save(args.save)
+        # with distributed training, rank 0 builds and saves the vocabulary, and the other processes load it,
+        # so that they do not write the same files concurrently, and all the models have the same vocabulary
+        if rank == 0:
+            vocab_sets = (train_sets + val_sets) if len(vocab_sets) == 0 else vocab_sets
+            logger.info(f'Building vocabulary')
+            numericalizer.build_vocab(Example.vocab_fields, vocab_sets)
+            numericalizer.save(args.save)
+        if world_size > 1:
+            torch.distributed.barrier()
+        if rank != 0:
+            numericalizer.load(args.save)
 
     logger.info(f'Initializing encoder and decoder embeddings')
     for vec in set(context_embeddings + question_embeddings + decoder_embeddings):
@@ -148,13 +166,54 @@ def prepare_data(args, logger):
 
     return numericalizer, context_embeddings, question_embeddings, decoder_embeddings, train_sets, val_sets, aux_sets
 
+def init_mixed_precision(args, device):
+    """
+    Returns the function creating the autocast context of the forward pass, and the gradient scaler (None when the
+    gradients do not need to be scaled)
+    """
+    if args.fp16:
+        if device.type != 'cuda':
+            raise ValueError('--fp16 is only supported on CUDA devices, use --bf16 instead')
+        if not hasattr(torch.cuda, 'amp'):
+            raise ValueError('--fp16 requires PyTorch 1.6 or later')
+        return torch.cuda.amp.autocast, torch.cuda.amp.GradScaler()
+    if args.bf16:
+        if not hasattr(torch, 'autocast'):
+            raise ValueError('--bf16 requires PyTorch 1.10 or later')
+        # bfloat16 has the same range as float32, so there is no need to scale the gradients
+        return partial(torch.autocast, device.type, dtype=torch.bfloat16), None
+    return contextlib.ExitStack, None
+
+
+def normalize_gradients(grads, normalizer):
+    if hasattr(torch, '_foreach_div_'):
+        torch._foreach_div_(grads, normalizer)
+    else:
+        for grad in grads:
+            grad.div_(normalizer)
+
+
+def clip_grad_norm(grads, max_norm):
+    """
+    Same as torch.nn.utils.clip_grad_norm_, but the norm is never read on the host, so it does not wait for the
+    device. Returns the norm (before clipping) as a tensor.
+    """
+    total_norm = torch.norm(torch.stack([torch.norm(grad.detach()) for grad in grads]))
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for grad in grads:
+        grad.mul_(clip_coef)
+    return total_norm
+
+
 accumulated_batch_lengths = 0
 
 def train_step(model, batch, iteration, opt, devices, lr_scheduler=None, grad_clip=None, pretraining=False,
                train_context_embeddings_after=None, train_question_embeddings_after=None,
-               gradient_accumulation_steps=1):
+               gradient_accumulation_steps=1, world_size=1, autocast=contextlib.ExitStack, grad_scaler=None):
     # Since the batch size is different in each call to this function due to dynamic batching, we need to keep track of
     # the total batch size
+    # To avoid waiting for the device, nothing is read on the host here: the loss and gradient norm are returned as
+    # tensors, and the caller checks them only when logging
     global accumulated_batch_lengths
     model.train()
     model.module.set_train_context_embeddings(train_context_embeddings_after is not None and
@@ -163,33 +222,169 @@ def train_step(model, batch, iteration, opt, devices, lr_scheduler=None, grad_cl
                                                iteration > train_question_embeddings_after)
     if (iteration) % gradient_accumulation_steps == 0:
         opt.zero_grad()
-    loss = model(batch, pretraining=pretraining)[0]
-    if torch.isnan(loss).any():
-        raise RuntimeError('Got NaN loss %s', str(loss))
-    if len(devices) > 1:
-        loss = loss.mean()
-    non_accumulated_loss = loss.item()
-    loss = loss*len(batch[0])
-    accumulated_batch_lengths += len(batch[0])
-
-    loss.backward()
+    is_update_step = (iteration+1) % gradient_accumulation_steps == 0
+    # with a single batch per update, the loss is already normalized by the batch size
+    normalize_by_batch_lengths = gradient_accumulation_steps > 1 or world_size > 1
+
+    # with DistributedDataParallel, gradients are only all-reduced on the step that updates the parameters
+    if world_size > 1 and not is_update_step:
+        sync_context = model.no_sync()
+    else:
+        sync_context = contextlib.ExitStack()
+    with sync_context:
+        with autocast():
+            loss = model(batch, pretraining=pretraining)[0]
+        if len(devices) > 1:
+            loss = loss.mean()
+        non_accumulated_loss = loss.detach()
+        if normalize_by_batch_lengths:
+            loss = loss*len(batch[0])
+            accumulated_batch_lengths += len(batch[0])
+
+        if grad_scaler is not None:
+            grad_scaler.scale(loss).backward()
+        else:
+            loss.backward()
     grad_norm = None
-    if (iteration+1) % gradient_accumulation_steps == 0:
-        for p in model.parameters():
-            if p.grad is None:
-                continue
-            # print('p.grad = ', p.grad)
-            p.grad /= accumulated_batch_lengths
-        accumulated_batch_lengths = 0
-        if grad_clip > 0.0:
-            grad_norm = torch.nn.utils.clip_grad_norm_(model.params, grad_clip)
-        opt.step()
+    if is_update_step:
+        if grad_scaler is not None:
+            # the gradients must be unscaled before they are normalized and clipped
+            grad_scaler.unscale_(opt)
+        grads = [p.grad for p in model.params if p.grad is not None]
+        if normalize_by_batch_lengths:
+            if world_size > 1:
+                # DistributedDataParallel averages the gradients over the processes, so we normalize by the
+                # average number of examples per process; gloo reduces CPU tensors, which does not wait for the device
+                reduce_device = 'cpu' if torch.distributed.get_backend() == 'gloo' else loss.device
+                total_batch_lengths = torch.tensor([accumulated_batch_lengths], dtype=torch.float, device=reduce_device)
+                torch.distributed.all_reduce(total_batch_lengths)
+                normalizer = total_batch_lengths.item() / world_size
+            else:
+                normalizer = accumulated_batch_lengths
+            normalize_gradients(grads, normalizer)
+            accumulated_batch_lengths = 0
+        if grad_clip > 0.0 and grads:
+            grad_norm = clip_grad_norm(grads, grad_clip)
+        if grad_scaler is not None:
+            # skips the update if the gradients overflowed
+            grad_scaler.step(opt)
+            grad_scaler.update()
+        else:
+            opt.step()
         if lr_scheduler is not None:
             lr_scheduler.step()
 
     return non_accumulated_loss, grad_norm
 
 
+def is_oom_error(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def discard_gradients(opt):
+    """Drop the gradients accumulated since the last update (after running out of memory in the middle of a step)"""
+    global accumulated_batch_lengths
+    opt.zero_grad()
+    accumulated_batch_lengths = 0
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def fits_in_memory(model, batch, autocast):
+    """Whether a training step on batch (forward and backward) fits in memory"""
+    model.train()
+    try:
+        with autocast():
+            loss = model(batch, pretraining=False)[0]
+        loss.mean().backward()
+        fits = True
+    except RuntimeError as e:
+        if not is_oom_error(e):
+            raise
+        fits = False
+    loss = None
+    for p in model.parameters():
+        p.grad = None
+    torch.cuda.empty_cache()
+    return fits
+
+
+def accumulation_steps_for(target_batch_tokens, batch_sizes):
+    """
+    The number of gradient accumulation steps for each update to cover target_batch_tokens tokens, when the tasks
+    (which take turns within an update) use the given numbers of tokens per batch
+    """
+    return max(1, math.ceil(target_batch_tokens * len(batch_sizes) / sum(batch_sizes)))
+
+
+def tune_batch_tokens(args, model, numericalizer, train_sets, device, logger, *, autocast, world_size=1):
+    """
+    Choose train_batch_tokens and gradient_accumulation_steps for the current model and device
+
+    Probes the largest batch of copies of the longest training example that fits in memory, then uses a bit less
+    than that (as margin for fragmentation) for every task, with enough gradient accumulation steps that each update
+    covers --target_batch_tokens tokens.
+    """
+    target_batch_tokens = args.target_batch_tokens or max(args.train_batch_values) * args.gradient_accumulation_steps
+    # also used to recompute the accumulation steps when backing off after running out of memory
+    args.target_batch_tokens = target_batch_tokens
+    if device.type != 'cuda':
+        logger.info('Not tuning the batch size, memory is only probed on CUDA devices')
+        return
+    if args.sentence_batching:
+        logger.warning('Not tuning the batch size, it is a number of examples with sentence batching')
+        return
+
+    longest, batch_size_fn = max(((ex, train_set.batch_size_fn) for train_set in train_sets for ex in train_set),
+                                 key=lambda x: x[1](x[0], 1, 0))
+    example_tokens = batch_size_fn(longest, 1, 0)
+
+    def probe(num_examples):
+        examples = [longest._replace(example_id=f'{longest.example_id}/probe{i}') for i in range(num_examples)]
+        batch = Batch.from_examples(examples, numericalizer, device=device,
+                                    append_question_to_context_too=args.append_question_to_context_too,
+                                    override_question=args.override_question, override_context=args.override_context)
+        # the wrapped model, so that distributed processes do not synchronize their probes
+        return fits_in_memory(model.module, batch, autocast)
+
+    # probing must not change the random state (dropout), so that seeded runs are reproducible,
+    # nor fill the output cache of frozen embeddings with the probe examples
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(torch.random.fork_rng(devices=[device.index if device.index is not None
+                                                           else torch.cuda.current_device()]))
+        for module in model.module.modules():
+            if isinstance(module, TransformerEmbedding):
+                stack.enter_context(module.output_cache_disabled())
+
+        # binary search on the number of copies of the longest example
+        low, high = 0, max(1, target_batch_tokens // example_tokens)
+        if probe(high):
+            low = high
+        else:
+            while high - low > 1:
+                middle = (low + high) // 2
+                if probe(middle):
+                    low = middle
+                else:
+                    high = middle
+    if low == 0:
+        raise ValueError(f'The longest training example ({example_tokens} tokens) does not fit in memory')
+
+    batch_tokens = low * example_tokens
+    if low < target_batch_tokens // example_tokens:
+        batch_tokens = int(batch_tokens * 0.9)
+    if world_size > 1:
+        # all processes must use the same number of accumulation steps
+        batch_tokens_tensor = torch.tensor([batch_tokens], device=device)
+        torch.distributed.all_reduce(batch_tokens_tensor, op=torch.distributed.ReduceOp.MIN)
+        batch_tokens = int(batch_tokens_tensor.item())
+
+    args.train_batch_values = [batch_tokens for _ in args.train_batch_values]
+    args.gradient_accumulation_steps = accumulation_steps_for(target_batch_tokens, args.train_batch_values)
+    logger.info(f'Using {batch_tokens} tokens per batch and {args.gradient_accumulation_steps} gradient accumulation '
+                f'steps for {target_batch_tokens} tokens per update')
+
+
 def update_fraction(args, task_iteration):
     if args.curriculum_strategy == 'linear':
         next_fraction = args.curriculum_rate * task_iteration
@@ -219,11 +414,46 @@ def should_log(iteration, log_every):
     return iteration % log_every == 0
 
 
+# how often the training loss is checked when not logging
+LOSS_CHECK_EVERY = 100
+
+
+def should_check_loss(iteration, log_every):
+    return iteration % (log_every or LOSS_CHECK_EVERY) == 0
+
+
+def check_training_loss(unchecked_loss, num_unchecked, iteration, world_size=1):
+    """
+    Read the sum of the training losses of the last num_unchecked iterations from the device (a single
+    synchronization), fail if it is not finite, and return their mean
+
+    With distributed training, the mean is taken over all the processes, so they all fail or stop together;
+    every process must call this at the same iteration.
+    """
+    mean_loss = unchecked_loss / num_unchecked
+    if world_size > 1:
+        # otherwise, the processes that keep training would wait for the others in the gradient all-reduce
+        mean_loss = mean_loss.detach().clone()
+        torch.distributed.all_reduce(mean_loss)
+        mean_loss /= world_size
+    mean_loss = float(mean_loss)
+    if not math.isfinite(mean_loss):
+        raise RuntimeError(f'Got a non-finite loss in the {num_unchecked} iterations before iteration {iteration}')
+    return mean_loss
+
+
 def do_validate(iteration, args, model, numericalizer, val_iters, *,
                 train_task, round_progress, task_progress, writer, logger):
+    val_results = [validate(val_task, val_iter, model, logger, numericalizer, iteration, args, num_print=args.num_print)
+                   for val_task, val_iter in val_iters]
+    return log_validation_results(iteration, args, val_results, train_task=train_task, round_progress=round_progress,
+                                  task_progress=task_progress, writer=writer, logger=logger)
+
+
+def log_validation_results(iteration, args, val_results, *,
+                           train_task, round_progress, task_progress, writer, logger):
     deca_score = 0
-    for val_task_idx, (val_task, val_iter) in enumerate(val_iters):
-        val_loss, metric_dict = validate(val_task, val_iter, model, logger, numericalizer, iteration, args, num_print=args.num_print)
+    for val_task, (val_loss, metric_dict) in zip(args.val_tasks, val_results):
         if val_loss is not None:
             log_entry = f'{args.timestamp}:{elapsed_time(logger)}:iteration_{iteration}:{round_progress}train_{train_task.name}:{task_progress}val_{val_task.name}:val_loss{val_loss.item():.4f}:'
             writer.add_scalar(f'loss/{val_task.name}/val', val_loss.item(), iteration)
@@ -250,8 +480,124 @@ def do_validate(iteration, args, model, numericalizer, val_iters, *,
     return deca_score
 
 
+def background_validation_worker(args, val_sets, device, requests, results):
+    """
+    Entry point of the background validation process: loads its own copy of the model, then validates each
+    (iteration, state_dict) snapshot it receives, until it receives None
+    """
+    logger = logging.getLogger(__name__)
+    numericalizer, context_embeddings, question_embeddings, decoder_embeddings = \
+        load_embeddings(args.embeddings, args.context_embeddings, args.question_embeddings, args.decoder_embeddings,
+                        args.max_generative_vocab, logger, output_cache=args.frozen_embeddings_cache,
+                        output_cache_max_memory=int(args.frozen_embeddings_cache_max_memory * 1024 ** 3),
+                        tie_transformer_embeddings=args.tie_transformer_embeddings)
+    numericalizer.load(args.save)
+    for vec in set(context_embeddings + question_embeddings + decoder_embeddings):
+        vec.init_for_vocab(numericalizer.vocab)
+    Model = getattr(models, args.model)
+    model = Model(numericalizer, args, context_embeddings, question_embeddings, decoder_embeddings)
+    model.to(device)
+
+    val_iters = [(task, make_data_loader(x, numericalizer, bs, device, train=False, valid=True,
+                                         append_question_to_context_too=args.append_question_to_context_too,
+                                         override_question=args.override_question, override_context=args.override_context))
+                 for task, x, bs in zip(args.val_tasks, val_sets, args.val_batch_size)]
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        iteration, state_dict = request
+        try:
+            model.load_state_dict(state_dict)
+            results.put([validate(val_task, val_iter, model, logger, numericalizer, iteration, args,
+                                  num_print=args.num_print)
+                         for val_task, val_iter in val_iters])
+        except Exception:
+            results.put(traceback.format_exc())
+
+
+class BackgroundValidator(object):
+    """
+    Validates snapshots of the model in a separate process, on its own device, while training continues
+
+    At most one validation is in flight; the caller must collect its result (with poll) before submitting the next one.
+    """
+
+    def __init__(self, args, val_sets, device):
+        context = torch.multiprocessing.get_context('spawn')
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(target=background_validation_worker,
+                                        args=(args, val_sets, device, self._requests, self._results), daemon=True)
+        self._process.start()
+        self._pending = None
+
+    def submit(self, iteration, model, **info):
+        """Validate the current weights of the model, tagged with iteration; info is returned with the results"""
+        assert self._pending is None
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in model.module.state_dict().items()}
+        self._requests.put((iteration, state_dict))
+        self._pending = (iteration, info)
+
+    def poll(self, block=False):
+        """
+        Returns (iteration, info, val_results) for the submitted validation, or None if nothing was submitted
+        or (if block is False) the validation is not done yet
+        """
+        if self._pending is None:
+            return None
+        try:
+            val_results = self._results.get(block=block)
+        except queue.Empty:
+            return None
+        if isinstance(val_results, str):
+            raise RuntimeError(f'Background validation failed:\n{val_results}')
+        iteration, info = self._pending
+        self._pending = None
+        return iteration, info, val_results
+
+    def close(self):
+        self._requests.put(None)
+        self._process.join()
+
+
+def finish_background_validation(result, args, best_decascore, *, saver, writer, logger):
+    """Log the results of a background validation, and mark its checkpoint as the best one if needed"""
+    if result is None:
+        return best_decascore
+    iteration, info, val_results = result
+    deca_score = log_validation_results(iteration, args, val_results, train_task=info['train_task'],
+                                        round_progress=info['round_progress'], task_progress=info['task_progress'],
+                                        writer=writer, logger=logger)
+    # like in synchronous validation, only checkpoints that were saved can become the best one
+    if info['saved'] and (best_decascore is None or best_decascore < deca_score):
+        best_decascore = deca_score
+        saver.mark_best(iteration, deca_score)
+        logger.info(
+            f'{args.timestamp}:{elapsed_time(logger)}:iteration_{iteration}:{info["round_progress"]}train_{info["train_task"].name}:{info["task_progress"]}found new best model')
+    return best_decascore
+
+
+def get_train_state(args, train_loaders, aux_loaders, task_iteration, task_idx, rnd):
+    """
+    The position of the training loop before training on task_idx in round rnd, including the position of the
+    data iterators (and their batch sizes) and the number of gradient accumulation steps, which can change during
+    training with --auto_batch_size, so that training can resume exactly from there
+    """
+    return {
+        'task_idx': task_idx,
+        'rnd': rnd,
+        'gradient_accumulation_steps': args.gradient_accumulation_steps,
+        'task_iteration': {task.name: value for task, value in task_iteration.items()},
+        'train_iterators': {task.name: loader.dataset.state_dict() for task, loader in train_loaders},
+        'aux_iterators': {task.name: loader.dataset.state_dict() for task, loader in aux_loaders},
+    }
+
+
 def maybe_save(iteration, model, opt, deca_score, best_decascore, *,
-               saver, logger, train_task, round_progress, task_progress, timestamp, log_dir):
+               saver, logger, train_task, round_progress, task_progress, timestamp, grad_scaler=None,
+               train_state=None):
     should_save_best = False
     if deca_score is not None and (best_decascore is None or best_decascore < deca_score):
         best_decascore = deca_score
@@ -259,8 +605,8 @@ def maybe_save(iteration, model, opt, deca_score, best_decascore, *,
 
     # punch through the nn.DataParallel to access the real model, otherwise we won't be able
     # to load this model later
+    # (the saver copies the tensors to the CPU before training continues)
     model_state_dict = model.module.state_dict()
-    model_state_dict = {k: v.cpu() for k, v in model_state_dict.items()}
 
     save_model_state_dict = {
         'model_state_dict': model_state_dict,
@@ -268,13 +614,16 @@ def maybe_save(iteration, model, opt, deca_score, best_decascore, *,
     }
     save_opt_state_dict = opt.state_dict()
     save_opt_state_dict.update({'start_iteration': iteration})
+    if train_state is not None:
+        save_opt_state_dict['train_state'] = train_state
+    if grad_scaler is not None:
+        save_opt_state_dict['grad_scaler'] = grad_scaler.state_dict()
 
-    saver.save(save_model_state_dict, save_opt_state_dict, global_step=iteration)
+    saver.save(save_model_state_dict, save_opt_state_dict, global_step=iteration, best=should_save_best,
+               decascore=best_decascore)
     if should_save_best:
         logger.info(
             f'{timestamp}:{elapsed_time(logger)}:iteration_{iteration}:{round_progress}train_{train_task.name}:{task_progress}found new best model')
-        torch.save(save_model_state_dict, os.path.join(log_dir, 'best.pth'))
-        torch.save(save_opt_state_dict, os.path.join(log_dir, 'best_optim.pth'))
 
     return best_decascore
 
@@ -304,11 +653,12 @@ def np_coin(prob):
 
 
 def get_next_batch(train_iter, aux_iters, *, task, task_idx, task_fraction, use_curriculum):
+    """Returns the next batch, and whether it comes from the aux set"""
     if use_curriculum:
         aux_iter = aux_iters[task_idx][1]
         prob = np_coin(task_fraction[task])
         if prob == 'aux':
-            return next(aux_iter)
+            return next(aux_iter), True
         else:
             assert prob == 'train'
             batch = next(train_iter)
@@ -316,13 +666,18 @@ def get_next_batch(train_iter, aux_iters, *, task, task_idx, task_fraction, use_
     else:
         batch = next(train_iter)
 
-    return batch
+    return batch, False
 
 
 def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations, numericalizer, *,
           log_every, val_every, save_every, rounds, val_sets, aux_sets, writer, logger, log_prefix,
-          start_iteration=1, rnd=1, best_decascore, use_curriculum, pretraining):
-    """main training function"""
+          start_iteration=1, rnd=1, best_decascore, use_curriculum, pretraining, rank=0, world_size=1,
+          autocast=contextlib.ExitStack, grad_scaler=None, train_state=None):
+    """main training function
+
+    With distributed training, each process trains on its own shard of every training set, and only rank 0
+    validates and saves the model
+    train_state, if given, is the position (returned by get_train_state) to resume training from"""
     local_loss, num_examples, len_contexts, len_answers, iteration = 0, 0, 0, 0, start_iteration
 
     train_iter_deep = deepcopy(train_iterations)
@@ -336,32 +691,73 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
         task_done[task] = False
         task_fraction[task] = 0.0
 
+    resume_task_idx = None
+    if train_state is not None:
+        rnd = train_state['rnd']
+        resume_task_idx = train_state['task_idx']
+        args.gradient_accumulation_steps = train_state.get('gradient_accumulation_steps',
+                                                           args.gradient_accumulation_steps)
+        for task in args.train_tasks:
+            task_iteration[task] = train_state['task_iteration'][task.name]
+            if use_curriculum and task_iteration[task] > 1:
+                task_fraction[task] = update_fraction(args, task_iteration[task] - 1)
+
     saver = Saver(args.log_dir, args.max_to_keep)
+    if args.load is not None and not pretraining:
+        # the score saved in a checkpoint can be older than the best checkpoint (e.g. with background validation)
+        saved_best_decascore = saver.best_decascore()
+        if saved_best_decascore is not None and (best_decascore is None or best_decascore < saved_best_decascore):
+            best_decascore = saved_best_decascore
     epoch = 0
 
     logger.info(f'Preparing iterators')
     main_device = devices[0]
+    # all the processes must shuffle the training data in the same way for the shards to be disjoint
+    shard_seed = args.seed if world_size > 1 else None
     train_iters = [(task,
                     make_data_loader(x, numericalizer, tok, main_device, paired=args.paired,max_pairs=args.max_pairs,
                                      train=True,  append_question_to_context_too=args.append_question_to_context_too,
-                                     override_question=args.override_question, override_context=args.override_context))
+                                     override_question=args.override_question, override_context=args.override_context,
+                                     rank=rank, world_size=world_size, seed=shard_seed))
                    for task, x, tok in zip(args.train_tasks, train_sets, args.train_batch_values)]
+    train_loaders = train_iters
+    if train_state is not None:
+        for task, train_loader in train_loaders:
+            train_loader.dataset.load_state_dict(train_state['train_iterators'][task.name])
     train_iters = [(task, iter(train_iter)) for task, train_iter in train_iters]
 
-    val_iters = [(task, make_data_loader(x, numericalizer, bs, main_device, train=False, valid=True,
-                                         append_question_to_context_too=args.append_question_to_context_too,
-                                         override_question=args.override_question, override_context=args.override_context))
-                 for task, x, bs in zip(args.val_tasks, val_sets, args.val_batch_size)]
+    val_iters = []
+    validator = None
+    if rank == 0 and args.async_validation and val_every is not None:
+        if args.async_validation_device is not None:
+            validation_device = torch.device(args.async_validation_device)
+        else:
+            validation_device = torch.device('cpu')
+        validator = BackgroundValidator(args, val_sets, validation_device)
+    elif rank == 0:
+        val_iters = [(task, make_data_loader(x, numericalizer, bs, main_device, train=False, valid=True,
+                                             append_question_to_context_too=args.append_question_to_context_too,
+                                             override_question=args.override_question, override_context=args.override_context))
+                     for task, x, bs in zip(args.val_tasks, val_sets, args.val_batch_size)]
 
     aux_iters = []
+    aux_loaders = []
     if use_curriculum:
         aux_iters = [(name, make_data_loader(x, numericalizer, tok, main_device, train=True,
                                              append_question_to_context_too=args.append_question_to_context_too,
-                                             override_question=args.override_question, override_context=args.override_context))
+                                             override_question=args.override_question, override_context=args.override_context,
+                                             rank=rank, world_size=world_size, seed=shard_seed))
                      for name, x, tok in zip(args.train_tasks, aux_sets, args.train_batch_values)]
+        aux_loaders = aux_iters
+        if train_state is not None:
+            for task, aux_loader in aux_loaders:
+                aux_loader.dataset.load_state_dict(train_state['aux_iterators'][task.name])
         aux_iters = [(task, iter(aux_iter)) for task, aux_iter in aux_iters]
         
+    # losses not checked for NaN yet (they stay on the device until they are checked)
+    unchecked_loss, num_unchecked = 0, 0
     zero_loss = 0
+    stop = False
     logger.info(f'Begin {log_prefix}')
 
     while not all(task_done.values()):
@@ -376,6 +772,11 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
             train_iterations = train_iter_deep
 
         for task_idx, (task, train_iter) in enumerate(train_iters):
+            if resume_task_idx is not None:
+                # resume in the middle of the round
+                if task_idx < resume_task_idx:
+                    continue
+                resume_task_idx = None
             task_iterations = train_iterations[task_idx] if train_iterations is not None else None
             if task_iterations == 0:
                 continue
@@ -383,20 +784,36 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
                 task_done[task] = True
                 continue
 
-            batch = get_next_batch(train_iter, aux_iters, task=task, task_idx=task_idx,
-                                   task_fraction=task_fraction, use_curriculum=use_curriculum)
-
-            if iteration < start_iteration:
-                # skip this iteration (this is done to ensure iterators are at the same position when resuming)
-                task_iteration[task] += 1
-                iteration += 1
-                return
-
             task_progress = f'{task_iteration[task]}/{task_iterations}:' if task_iterations is not None else ''
             round_progress = f'round_{rnd}:' if rounds else ''
 
+            # never save a model trained on non-finite losses; this is checked by every process, since they must agree
+            if num_unchecked > 0 and should_save(iteration, save_every) and \
+                    should_validate(iteration, val_every, resume=args.resume, start_iteration=start_iteration):
+                check_training_loss(unchecked_loss, num_unchecked, iteration, world_size=world_size)
+
             # validate
-            if should_validate(iteration, val_every, resume=args.resume, start_iteration=start_iteration):
+            if validator is not None:
+                best_decascore = finish_background_validation(validator.poll(), args, best_decascore,
+                                                              saver=saver, writer=writer, logger=logger)
+
+            if validator is not None and should_validate(iteration, val_every, resume=args.resume,
+                                                         start_iteration=start_iteration):
+                # the previous validation must be done first: if it is the best, its checkpoint must still exist
+                best_decascore = finish_background_validation(validator.poll(block=True), args, best_decascore,
+                                                              saver=saver, writer=writer, logger=logger)
+                saved = should_save(iteration, save_every)
+                if saved:
+                    best_decascore = maybe_save(iteration, model, opt, None, best_decascore,
+                                                saver=saver, logger=logger, train_task=task,
+                                                round_progress=round_progress, task_progress=task_progress,
+                                                timestamp=args.timestamp, grad_scaler=grad_scaler,
+                                                train_state=get_train_state(args, train_loaders, aux_loaders,
+                                                                            task_iteration, task_idx, rnd))
+                validator.submit(iteration, model, saved=saved, train_task=task,
+                                 round_progress=round_progress, task_progress=task_progress)
+
+            elif rank == 0 and should_validate(iteration, val_every, resume=args.resume, start_iteration=start_iteration):
                 deca_score = do_validate(iteration, args, model, numericalizer, val_iters,
                                          train_task=task, round_progress=round_progress,
                                          task_progress=task_progress, writer=writer, logger=logger)
@@ -406,42 +823,75 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
                     best_decascore = maybe_save(iteration, model, opt, deca_score, best_decascore,
                                                 saver=saver, logger=logger, train_task=task,
                                                 round_progress=round_progress, task_progress=task_progress,
-                                                timestamp=args.timestamp, log_dir=args.log_dir)
+                                                timestamp=args.timestamp, grad_scaler=grad_scaler,
+                                                train_state=get_train_state(args, train_loaders, aux_loaders,
+                                                                            task_iteration, task_idx, rnd))
+
+            # the batch is fetched after saving, so that the saved position of the iterators is right before it
+            batch, is_aux_batch = get_next_batch(train_iter, aux_iters, task=task, task_idx=task_idx,
+                                                 task_fraction=task_fraction, use_curriculum=use_curriculum)
 
             # param update
-            loss, grad_norm = train_step(model, batch, iteration, opt, devices, lr_scheduler=lr_scheduler,
-                                         grad_clip=args.grad_clip, pretraining=pretraining,
-                                         gradient_accumulation_steps=args.gradient_accumulation_steps,
-                                         train_context_embeddings_after=args.train_context_embeddings_after if
-                                                                        args.train_context_embeddings else None,
-                                         train_question_embeddings_after=args.train_question_embeddings_after if
-                                                                         args.train_question_embeddings else None)
+            try:
+                loss, grad_norm = train_step(model, batch, iteration, opt, devices, lr_scheduler=lr_scheduler,
+                                             grad_clip=args.grad_clip, pretraining=pretraining,
+                                             gradient_accumulation_steps=args.gradient_accumulation_steps,
+                                             world_size=world_size, autocast=autocast, grad_scaler=grad_scaler,
+                                             train_context_embeddings_after=args.train_context_embeddings_after if
+                                                                            args.train_context_embeddings else None,
+                                             train_question_embeddings_after=args.train_question_embeddings_after if
+                                                                             args.train_question_embeddings else None)
+            except RuntimeError as e:
+                # with distributed training, the other processes would wait for this one forever
+                if not (args.auto_batch_size and world_size == 1 and is_oom_error(e)):
+                    raise
+                loss = None
             if loss is None:
-                logger.info(
-                    'Encountered NAN loss during training... Continue training ignoring the current batch')
+                # out of memory: skip the batch, and halve the batch size of the iterator it comes from (unless
+                # the batch was formed before the last time we halved it), with enough accumulation steps to keep
+                # the number of tokens per update
+                discard_gradients(opt)
+                batch_iterator = (aux_loaders if is_aux_batch else train_loaders)[task_idx][1].dataset
+                if batch_iterator.last_batch_size == batch_iterator.batch_size:
+                    batch_iterator.batch_size = max(1, batch_iterator.batch_size // 2)
+                    args.gradient_accumulation_steps = accumulation_steps_for(
+                        args.target_batch_tokens, [loader.dataset.batch_size for _task, loader in train_loaders])
+                logger.warning(f'Out of memory at iteration {iteration}, skipping the batch; now using '
+                               f'{batch_iterator.batch_size} tokens per batch for {task.name} and '
+                               f'{args.gradient_accumulation_steps} gradient accumulation steps')
                 continue
-            if loss < 1e-6:
-                zero_loss += 1
-                if zero_loss >= 100:
-                    logger.info('Found loss less than 1e-5 for 100 steps, stopping.')
-                    return
-            else:
-                zero_loss = 0
 
             # update curriculum fraction
             if args.use_curriculum:
                 task_fraction[task] = update_fraction(args, task_iteration[task])
 
-            # train metrics
+            # train metrics (the loss stays on the device until we check or log it)
             local_loss += loss
+            unchecked_loss += loss
+            num_unchecked += 1
 
             # train logs
             num_examples += batch.context.value.size(0)
             len_contexts += batch.context.value.size(1)
             len_answers += batch.answer.value.size(1)
 
+            # checked even without logging
+            if should_check_loss(iteration, log_every):
+                mean_loss = check_training_loss(unchecked_loss, num_unchecked, iteration, world_size=world_size)
+                if mean_loss < 1e-6:
+                    zero_loss += num_unchecked
+                    if zero_loss >= 100:
+                        logger.info('Found loss less than 1e-6 for 100 steps, stopping.')
+                        stop = True
+                        break
+                else:
+                    zero_loss = 0
+                unchecked_loss, num_unchecked = 0, 0
+
             if should_log(iteration, log_every):
-                local_loss /= log_every
+                local_loss = float(local_loss) / log_every
+                if grad_norm is not None:
+                    grad_norm = float(grad_norm)
                 num_examples /= log_every
                 len_contexts /= log_every
                 len_answers /= log_every
@@ -459,15 +909,23 @@ def train(args, devices, model, opt, lr_scheduler, train_sets, train_iterations,
             task_iteration[task] += 1
             iteration += 1
 
+        if stop:
+            break
+
         # book keeping
         epoch += 1
         rnd += 1
 
+    if validator is not None:
+        best_decascore = finish_background_validation(validator.poll(block=True), args, best_decascore,
+                                                      saver=saver, writer=writer, logger=logger)
+        validator.close()
+    saver.close()
     logger.info(f'{log_prefix} is done after {epoch} epochs')
 
 
 def init_model(args, numericalizer, context_embeddings, question_embeddings, decoder_embeddings, devices, logger,
-               save_dict):
+               save_dict, world_size=1):
     model_name = args.model
     logger.info(f'Initializing {model_name}')
     Model = getattr(models, model_name)
@@ -478,10 +936,16 @@ def init_model(args, numericalizer, context_embeddings, question_embeddings, dec
     if save_dict is not None:
         logger.info(f'Loading model from {os.path.join(args.save, args.load)}')
         save_dict = torch.load(os.path.join(args.save, args.load))
-        model.load_state_dict(save_dict['model_state_dict'])
+        load_model_state_dict(model, save_dict['model_state_dict'])
 
     model.to(devices[0])
-    model = NamedTupleCompatibleDataParallel(model, device_ids=devices)
+    if world_size > 1:
+        # parameters that are frozen for the first iterations (e.g. pretrained embeddings) receive no gradient
+        model = NamedTupleCompatibleDistributedDataParallel(model,
+                                                            device_ids=devices if devices[0].type == 'cuda' else None,
+                                                            find_unused_parameters=True)
+    else:
+        model = NamedTupleCompatibleDataParallel(model, device_ids=devices)
     model.params = params
 
     return model
@@ -527,14 +991,9 @@ def init_opt(args, model, logger):
     return opt, scheduler
 
 
-def main(args):
-    args = arguments.post_parse(args)
-    if args is None:
-        return
-
+def run(args, devices, rank=0, world_size=1):
     set_seed(args)
-    devices = init_devices(args, args.devices)
-    logger = initialize_logger(args)
+    logger = initialize_logger(args, rank)
     logger.info(f'Arguments:\n{pformat(vars(args))}')
 
     save_dict = None
@@ -542,7 +1001,7 @@ def main(args):
         logger.info(f'Loading vocab from {os.path.join(args.save, args.load)}')
         save_dict = torch.load(os.path.join(args.save, args.load))
     numericalizer, context_embeddings, question_embeddings, decoder_embeddings, train_sets, val_sets, aux_sets = \
-        prepare_data(args, logger)
+        prepare_data(args, logger, rank=rank, world_size=world_size)
     if (args.use_curriculum and aux_sets is None) or (not args.use_curriculum and len(aux_sets)):
         logging.error('sth unpleasant is happening with curriculum')
 
@@ -550,19 +1009,31 @@ def main(args):
     logger.start = time.time()
 
     model = init_model(args, numericalizer, context_embeddings, question_embeddings, decoder_embeddings,
-                       devices, logger, save_dict)
+                       devices, logger, save_dict, world_size=world_size)
     opt, lr_scheduler = init_opt(args, model, logger)
+    autocast, grad_scaler = init_mixed_precision(args, devices[0])
+    if args.auto_batch_size:
+        tune_batch_tokens(args, model, numericalizer, train_sets, devices[0], logger,
+                          autocast=autocast, world_size=world_size)
     start_iteration = 1
+    train_state = None
 
 
     if save_dict is not None and args.resume:
         logger.info(f'Resuming Training from {os.path.splitext(args.load)[0]}_optim.pth')
         opt_state_dict = torch.load(os.path.join(args.save, f'{os.path.splitext(args.load)[0]}_optim.pth'))
         start_iteration = opt_state_dict.pop('start_iteration')
+        grad_scaler_state_dict = opt_state_dict.pop('grad_scaler', None)
+        if grad_scaler is not None and grad_scaler_state_dict is not None:
+            grad_scaler.load_state_dict(grad_scaler_state_dict)
+        train_state = opt_state_dict.pop('train_state', None)
+        if train_state is None:
+            logger.warning('The checkpoint does not record the position of the training data, '
+                           'training will restart from the beginning of the datasets')
         logger.info(f'Starting iteration is {start_iteration}')
         opt.load_state_dict(opt_state_dict)
 
-    if hasattr(args, 'tensorboard') and args.tensorboard:
+    if rank == 0 and hasattr(args, 'tensorboard') and args.tensorboard:
         logger.info(f'Initializing Writer')
         writer = SummaryWriter(log_dir=args.tensorboard_dir, purge_step=start_iteration)
     else:
@@ -575,11 +1046,55 @@ def main(args):
               train_iterations, numericalizer, val_sets=[], aux_sets=[], logger=logger, writer=writer,
               log_every=args.log_every, val_every=None, save_every=None, use_curriculum=False,
               rounds=len(train_sets) > 1, start_iteration=start_iteration, best_decascore=0,
-              pretraining=True, log_prefix='pretrain')
+              pretraining=True, log_prefix='pretrain', rank=rank, world_size=world_size,
+              autocast=autocast, grad_scaler=grad_scaler)
 
     train(args, devices, model, opt, lr_scheduler, train_sets,
           args.train_iterations, numericalizer, val_sets=val_sets, aux_sets=aux_sets, logger=logger, writer=writer,
           log_every=args.log_every, val_every=args.val_every, save_every=args.save_every,
           rounds=len(train_sets) > 1, start_iteration=start_iteration, use_curriculum=args.use_curriculum,
           best_decascore=save_dict.get('best_decascore') if save_dict is not None else None,
-          pretraining=False, log_prefix='training')
+          pretraining=False, log_prefix='training', rank=rank, world_size=world_size,
+          autocast=autocast, grad_scaler=grad_scaler, train_state=train_state)
+
+
+def distributed_worker(local_rank, args, devices):
+    """entry point of each process in distributed training, which trains on devices[local_rank]"""
+    device = devices[local_rank]
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    elif args.threads_per_worker:
+        # otherwise every process would use all the cores, and they would compete with each other
+        torch.set_num_threads(args.threads_per_worker)
+    world_size = args.num_nodes * len(devices)
+    rank = args.node_rank * len(devices) + local_rank
+    torch.distributed.init_process_group(backend=args.dist_backend,
+                                         init_method=args.dist_url or 'file://' + args.dist_sync_file,
+                                         world_size=world_size, rank=rank,
+                                         timeout=datetime.timedelta(minutes=args.dist_timeout))
+    try:
+        run(args, [device], rank=rank, world_size=world_size)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def main(args):
+    args = arguments.post_parse(args)
+    if args is None:
+        return
+
+    devices = init_devices(args, args.devices)
+    if args.cpu_workers > 0 and devices[0].type == 'cpu':
+        # CPU data parallel training: every process trains on the CPU, and gradients are all-reduced through gloo
+        devices = [devices[0]] * args.cpu_workers
+        args.distributed = True
+        args.dist_backend = 'gloo'
+        if args.threads_per_worker is None:
+            args.threads_per_worker = max(1, (os.cpu_count() or 1) // args.cpu_workers)
+    if args.distributed:
+        # a synchronization file left over by a previous run would prevent the processes from meeting
+        if args.dist_url is None and args.node_rank == 0 and os.path.exists(args.dist_sync_file):
+            os.unlink(args.dist_sync_file)
+        torch.multiprocessing.spawn(distributed_worker, args=(args, devices), nprocs=len(devices))
+    else:
+        run(args, devices)
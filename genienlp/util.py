@@ -29,6 +29,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import functools
 import json
 from json.decoder import JSONDecodeError
 import logging
@@ -431,6 +432,25 @@ def log_model_size(logger, model, model_name):
     logger.info(f'{model_name} has {num_param:,} parameters')
 
 
+def load_model_state_dict(model, state_dict):
+    """
+    Load `state_dict` into `model`, refusing checkpoints that have different weights for parameters the model ties
+    together (e.g. untied context and question embeddings, loaded with --tie_transformer_embeddings), because
+    loading them would silently keep one copy and drop the others.
+    """
+    tied_names = dict()
+    for name, tensor in model.state_dict().items():
+        if tensor.numel() > 0:
+            tied_names.setdefault(tensor.data_ptr(), []).append(name)
+    for names in tied_names.values():
+        names = [name for name in names if name in state_dict]
+        for name in names[1:]:
+            if not torch.equal(state_dict[names[0]], state_dict[name]):
+                raise ValueError(f'{names[0]} and {name} are tied in the model, but have different weights in the '
+                                 f'checkpoint; load this checkpoint without --tie_transformer_embeddings')
+    model.load_state_dict(state_dict)
+
+
 def elapsed_time(log):
     t = time.time() - log.start
     day = int(t // (24 * 3600))
@@ -444,14 +464,19 @@ def elapsed_time(log):
 
 
 def make_data_loader(dataset, numericalizer, batch_size, device=None, paired=False, max_pairs=None, train=False,
-                     valid=False, append_question_to_context_too=False, override_question=None, override_context=None):
+                     valid=False, append_question_to_context_too=False, override_question=None, override_context=None,
+                     sort=False, rank=0, world_size=1, seed=None):
     
     iterator = Iterator(dataset,
                         batch_size,
                         shuffle=train,
                         repeat=train,
                         use_data_batch_fn=train,
-                        use_data_sort_key=train)
+                        use_data_sort_key=train,
+                        sort=sort,
+                        rank=rank,
+                        world_size=world_size,
+                        seed=seed)
     
     collate_function = lambda minibatch: Batch.from_examples(minibatch, numericalizer, device=device,
                                            paired=paired and train, max_pairs=max_pairs, groups=iterator.groups,
@@ -474,6 +499,44 @@ def pad(x, new_channel, dim, val=None):
     return torch.cat([x, padding], dim)
 
 
+@functools.lru_cache(maxsize=None)
+def token_id_tensor(token_ids, device):
+    """
+    A 1D tensor of `token_ids` (a tuple) on `device`; it is cached, so the ids are only copied to the device once
+    """
+    return torch.tensor(token_ids, dtype=torch.long, device=device)
+
+
+def isin(elements: torch.Tensor, test_elements: torch.Tensor):
+    """
+    Boolean tensor of the same shape as `elements`, True where the element is one of `test_elements` (a 1D tensor)
+    """
+    if hasattr(torch, 'isin'):
+        return torch.isin(elements, test_elements)
+    # torch < 1.10; `test_elements` is a handful of special token ids, so broadcasting is cheap
+    return (elements.unsqueeze(-1) == test_elements).any(-1)
+
+
+def mask_for_mlm(inputs: torch.Tensor, special_tokens_mask: torch.Tensor, mask_id, vocab_size, probability):
+    """
+    Choose tokens for masked language modeling, with probability `probability` among all tokens where
+    `special_tokens_mask` is False, and corrupt them: 80% become `mask_id`, 10% a random token, 10% are left unchanged.
+
+    Everything happens on the device of `inputs`, without synchronizing with the host. `inputs` is not modified.
+    Returns the corrupted inputs, and the boolean mask of the chosen tokens.
+    """
+    masked_indices = (torch.rand(inputs.shape, device=inputs.device) < probability) & ~special_tokens_mask
+
+    # a single draw decides between [MASK] (80%), a random token (10%) and the original token (10%)
+    replacement = torch.rand(inputs.shape, device=inputs.device)
+    indices_replaced = masked_indices & (replacement < 0.8)
+    indices_random = masked_indices & (replacement >= 0.9)
+
+    random_words = torch.randint(vocab_size, inputs.shape, dtype=inputs.dtype, device=inputs.device)
+    inputs = torch.where(indices_random, random_words, inputs.masked_fill(indices_replaced, mask_id))
+    return inputs, masked_indices
+
+
 def have_multilingual(task_names):
     return any(['multilingual' in name for name in task_names])
 
@@ -491,7 +554,8 @@ def load_config_json(args):
                     'train_context_embeddings_after', 'train_question_embeddings_after',
                     'pretrain_context', 'pretrain_mlm_probability', 'force_subword_tokenize',
                     'append_question_to_context_too', 'almond_preprocess_context', 'almond_lang_as_question',
-                    'override_question', 'override_context', 'almond_has_multiple_programs']
+                    'override_question', 'override_context', 'almond_has_multiple_programs',
+                    'tie_transformer_embeddings']
 
         # train and predict scripts have these arguments in common. We use the values from train only if they are not provided in predict
         if 'num_beams' in config and not isinstance(config['num_beams'], list):
@@ -506,7 +570,7 @@ def load_config_json(args):
             if r in config:
                 setattr(args, r, config[r])
             # These are for backward compatibility with models that were trained before we added these arguments
-            elif r == 'almond_has_multiple_programs':
+            elif r in ('almond_has_multiple_programs', 'tie_transformer_embeddings'):
                 setattr(args, r, False)
             elif r == 'almond_lang_as_question':
                 setattr(args, r, False)
@@ -35,21 +35,26 @@ from .metrics import compute_metrics
 from collections import OrderedDict
 
 
-def generate_with_model(model, data_iterator, numericalizer, task, args, prediction_file_name=None, output_predictions_only=False):
+def generate_with_model(model, data_iterator, numericalizer, task, args, prediction_file_name=None, output_predictions_only=False,
+                        original_order=None):
     """
+    original_order, if given, is the position in the dataset of each example in the order of data_iterator;
+    the outputs and the prediction file then follow the dataset order
     """
-    if isinstance(model, torch.nn.DataParallel):
+    if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
         # get rid of the DataParallel wrapper
         model = model.module
+    example_ids = []
     predictions = []
     answers = []
     contexts = []
     questions = []
-    if prediction_file_name is not None:
-        prediction_file = open(prediction_file_name, 'w' + ('' if args.overwrite else 'x'))
     for batch_idx, batch in enumerate(data_iterator):
         batch_size = len(batch.example_id)
         batch_prediction = [[] for _ in range(batch_size)] # a list where each element is a list of outputs for one input
+        # the encoder output does not depend on the generation hyperparameters, so we compute it once per batch
+        encoder_output = model.encoder(batch)
+        constraint = task.decoding_constraint(batch.decoder_vocab, device=batch.context.value.device)
         for hyperparameter_idx in range(len(args.temperature)):
             partial_batch_prediction = model.generate(batch,
                                                 max_output_length=args.max_output_length,
@@ -60,7 +65,9 @@ def generate_with_model(model, data_iterator, numericalizer, task, args, predict
                                                 top_p=args.top_p[hyperparameter_idx],
                                                 num_beams=args.num_beams[hyperparameter_idx],
                                                 no_repeat_ngram_size=args.no_repeat_ngram_size[hyperparameter_idx],
-                                                do_sample=args.temperature[hyperparameter_idx]!=0  # if temperature==0, we do not sample
+                                                do_sample=args.temperature[hyperparameter_idx]!=0,  # if temperature==0, we do not sample
+                                                encoder_output=encoder_output,
+                                                constraint=constraint
                                                 )
             partial_batch_prediction = numericalizer.reverse(partial_batch_prediction, detokenize=task.detokenize, field_name='answer')
             for i in range(len(partial_batch_prediction)):
@@ -74,11 +81,19 @@ def generate_with_model(model, data_iterator, numericalizer, task, args, predict
             batch_context = numericalizer.reverse(batch.context.value.data, detokenize=task.detokenize, field_name='context')
             contexts += batch_context
         predictions += batch_prediction
-        if prediction_file_name is not None:
-            for i, example_id in enumerate(batch.example_id):
-                prediction_file.write(example_id + '\t' + '\t'.join(batch_prediction[i]) + '\n') # write all outputs in the prediction file, separated by \t
+        example_ids += batch.example_id
+
+    if original_order is not None:
+        # sort back to the original order
+        order = sorted(range(len(original_order)), key=lambda i: original_order[i])
+        example_ids, predictions, answers, contexts, questions = \
+            ([values[i] for i in order] if values else values
+             for values in (example_ids, predictions, answers, contexts, questions))
+
     if prediction_file_name is not None:
-        prediction_file.close()
+        with open(prediction_file_name, 'w' + ('' if args.overwrite else 'x')) as prediction_file:
+            for example_id, example_prediction in zip(example_ids, predictions):
+                prediction_file.write(example_id + '\t' + '\t'.join(example_prediction) + '\n') # write all outputs in the prediction file, separated by \t
     
     if output_predictions_only:
         return predictions
@@ -24,6 +24,11 @@ else
   done
 fi
 
+# unit tests
+pipenv run python3 $SRCDIR/test_thingtalk_constraints.py
+pipenv run python3 $SRCDIR/test_search.py
+pipenv run python3 $SRCDIR/test_iterator.py
+
 TMPDIR=`pwd`
 workdir=`mktemp -d $TMPDIR/genieNLP-tests-XXXXXX`
 trap on_error ERR INT TERM
@@ -46,6 +51,13 @@ do
     # greedy prediction
     pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache
 
+    # beam search
+    pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache --num_beams 2
+
+    # sampling, and constrained beam search, with multiple outputs
+    pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache --num_outputs 2 --temperature 0.5 --top_p 0.9
+    pipenv run python3 -m genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results/ --data $SRCDIR/dataset/ --embeddings $embedding_dir --skip_cache --num_beams 2 --num_outputs 2 --thingtalk_constraints
+
     # check if result file exists
     if test ! -f $workdir/model_$i/eval_results/test/almond.tsv ; then
         echo "File not found!"
@@ -0,0 +1,69 @@
+#
+# Copyright (c) 2020, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# unit tests of saving and restoring the position of an Iterator
+
+import itertools
+
+from genienlp.data_utils.iterator import Iterator
+
+DATASET = list(range(10))
+
+
+def make_iterator(seed=123):
+    return Iterator(DATASET, batch_size=3, shuffle=True, repeat=True, seed=seed)
+
+
+def test_resume():
+    iterator = make_iterator()
+    batches = iter(iterator)
+    next(batches)
+    next(batches)
+    state = iterator.state_dict()
+    expected = list(itertools.islice(batches, 6))
+
+    restored = make_iterator(seed=456)
+    restored.load_state_dict(state)
+    assert list(itertools.islice(iter(restored), 6)) == expected
+
+
+def test_resume_before_start():
+    # e.g. the iterator of a task that was not reached before the checkpoint was saved
+    state = make_iterator().state_dict()
+    assert state['epoch_random_state'] is None
+
+    restored = make_iterator(seed=456)
+    restored.load_state_dict(state)
+    epoch = list(itertools.islice(iter(restored), 4))
+    assert sorted(example for batch in epoch for example in batch) == DATASET
+
+
+if __name__ == '__main__':
+    test_resume()
+    test_resume_before_start()
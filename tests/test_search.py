@@ -0,0 +1,165 @@
+#
+# Copyright (c) 2020, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# unit tests of the search algorithms, with a toy decoder
+
+import torch
+from torch.nn import functional as F
+
+from genienlp.models import search
+
+PAD = 0
+EOS = 1
+VOCAB_SIZE = 6
+# the initial token is not in the decoder vocabulary
+INIT = VOCAB_SIZE
+MAX_LENGTH = 8
+
+
+class ToyDecoderState(object):
+    """
+    A decoder state where the next token only depends on the input and on the last token
+
+    Like MQANDecoderWrapper, it keeps what depends on the input once per input, and checks that every step
+    has one row per hypothesis.
+    """
+
+    def __init__(self, input_scores, transition_scores):
+        # batch x vocab, and (vocab + 1) x vocab where the last row follows the initial token
+        self.input_scores = input_scores
+        self.transition_scores = transition_scores
+        self.num_hypotheses = 1
+
+    def expand(self, num_hypotheses):
+        self.num_hypotheses *= num_hypotheses
+
+    def reorder(self, new_order, inputs=None):
+        if inputs is not None:
+            self.num_hypotheses = new_order.size(0) // inputs.size(0)
+            self.input_scores = self.input_scores.index_select(0, inputs)
+
+    def next_token_log_probs(self, current_token_id):
+        assert current_token_id.size(0) == self.input_scores.size(0) * self.num_hypotheses
+        scores = self.input_scores.repeat_interleave(self.num_hypotheses, dim=0) + \
+            self.transition_scores[current_token_id.squeeze(1)]
+        return F.log_softmax(scores, dim=-1)
+
+
+class NoThreeConstraint(search.DecodingConstraint):
+    """
+    Token 3 can never be generated, and the output has at least 3 tokens; the state is the number of tokens so far
+    """
+
+    def initial_state(self):
+        return 0
+
+    def next_state(self, state, token_id):
+        return state + 1
+
+    def disallowed_tokens(self, state):
+        disallowed = torch.zeros((VOCAB_SIZE,), dtype=torch.bool)
+        disallowed[3] = True
+        if state < 3:
+            disallowed[EOS] = True
+        return disallowed
+
+
+def make_decoder_state(batch_size):
+    # after the initial token 2, then 3, then the end; every input prefers a different token among 4 and 5
+    transition_scores = torch.zeros((VOCAB_SIZE + 1, VOCAB_SIZE))
+    transition_scores[INIT, 2] = 5.0
+    transition_scores[2, 3] = 5.0
+    transition_scores[3, EOS] = 5.0
+    transition_scores[4, EOS] = 2.0
+    transition_scores[5, EOS] = 2.0
+    input_scores = torch.zeros((batch_size, VOCAB_SIZE))
+    input_scores[:, PAD] = -1e4
+    input_scores[0::2, 4] = 1.0
+    input_scores[1::2, 5] = 1.0
+    return ToyDecoderState(input_scores, transition_scores)
+
+
+def generate(batch_size, **kwargs):
+    return search.generate(make_decoder_state(batch_size), batch_size=batch_size, init_token_id=INIT,
+                           eos_token_id=EOS, pad_token_id=PAD, map_to_full=lambda token_ids: token_ids,
+                           device=torch.device('cpu'), max_length=MAX_LENGTH, **kwargs)
+
+
+def check_outputs(generated, num_rows, constraint=None):
+    """
+    Check that every row of `generated` is the initial token, then some tokens, then the end and padding
+    """
+    assert generated.size(0) == num_rows
+    for row in generated.tolist():
+        assert row[0] == INIT
+        length = row.index(EOS) if EOS in row else len(row)
+        assert all(token not in (PAD, EOS, INIT) for token in row[1:length]), row
+        assert all(token == PAD for token in row[length + 1:]), row
+        if constraint is not None:
+            assert 3 not in row and length > 3, row
+
+
+def test_greedy():
+    generated = generate(3)
+    check_outputs(generated, 3)
+    assert generated.tolist() == [[INIT, 2, 3, EOS]] * 3
+
+
+def test_beam_search():
+    generated = generate(3, num_beams=3, num_outputs=2)
+    check_outputs(generated, 6)
+    # the outputs of the same input are contiguous, the best one first
+    outputs = generated.tolist()
+    for i in range(3):
+        assert outputs[2 * i][:4] == [INIT, 2, 3, EOS]
+        assert outputs[2 * i + 1] != outputs[2 * i]
+
+
+def test_sampling():
+    torch.manual_seed(123)
+    generated = generate(3, num_outputs=4, do_sample=True, temperature=2.0)
+    check_outputs(generated, 12)
+
+
+def test_constraint_with_multiple_hypotheses():
+    constraint = NoThreeConstraint()
+    check_outputs(generate(3, constraint=constraint), 3, constraint)
+    check_outputs(generate(3, num_beams=3, num_outputs=2, constraint=constraint), 6, constraint)
+    torch.manual_seed(123)
+    check_outputs(generate(3, num_outputs=4, do_sample=True, temperature=2.0, constraint=constraint), 12, constraint)
+    # the best beam and the greedy output avoid the disallowed token, but otherwise follow the decoder
+    for row in generate(2, num_beams=2, constraint=constraint).tolist():
+        assert row[1] == 2
+
+
+if __name__ == '__main__':
+    test_greedy()
+    test_beam_search()
+    test_sampling()
+    test_constraint_with_multiple_hypotheses()
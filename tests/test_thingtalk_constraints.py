@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2020, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# unit tests of the ThingTalk decoding constraint
+
+from genienlp.data_utils.numericalizer.decoder_vocab import DecoderVocabulary
+from genienlp.tasks.almond.constraints import ThingTalkGrammar
+
+WORDS = ['<pad>', '</s>', 'now', '=>', 'on', '=', '"', 'notify', 'hello',
+         '@com.instagram.get_pictures', '@com.gmail.send_email', '@com.twitter.post',
+         'param:caption:String', 'param:picture_url:Entity(tt:picture)', 'param:message:String', 'param:status:String']
+
+FUNCTIONS = {
+    '@com.instagram.get_pictures': {'caption', 'picture_url'},
+    '@com.gmail.send_email': {'message'},
+}
+
+
+def make_constraint():
+    vocab = DecoderVocabulary(WORDS, None, pad_token='<pad>', eos_token='</s>')
+    return ThingTalkGrammar(FUNCTIONS).for_vocab(vocab), vocab
+
+
+def check_program(program):
+    """
+    Check that every token of `program` (and the end of sentence) is allowed by the constraint
+    """
+    constraint, vocab = make_constraint()
+    state = constraint.initial_state()
+    for token in program.split(' ') + ['</s>']:
+        token_id = vocab.stoi[token]
+        assert not constraint.disallowed_tokens(state)[token_id], f'{token} was disallowed in {program}'
+        state = constraint.next_state(state, token_id)
+    return constraint, state
+
+
+def test_parameter_passing():
+    # param:caption is an output of @com.instagram.get_pictures, passed to @com.gmail.send_email
+    check_program('now => @com.instagram.get_pictures => @com.gmail.send_email on param:message:String = param:caption:String')
+
+
+def test_unknown_parameters_and_functions():
+    constraint, vocab = make_constraint()
+    state = constraint.initial_state()
+    assert constraint.disallowed_tokens(state)[vocab.stoi['@com.twitter.post']]
+    for token in 'now => @com.instagram.get_pictures => @com.gmail.send_email on'.split(' '):
+        state = constraint.next_state(state, vocab.stoi[token])
+    mask = constraint.disallowed_tokens(state)
+    assert not mask[vocab.stoi['param:message:String']]
+    assert not mask[vocab.stoi['param:caption:String']]
+    assert mask[vocab.stoi['param:status:String']]
+
+
+def test_quotes():
+    check_program('now => @com.gmail.send_email param:message:String = " hello "')
+    constraint, vocab = make_constraint()
+    state = constraint.initial_state()
+    for token in 'now => @com.gmail.send_email param:message:String = "'.split(' '):
+        state = constraint.next_state(state, vocab.stoi[token])
+    mask = constraint.disallowed_tokens(state)
+    assert mask[vocab.eos_idx] and mask[vocab.stoi['"']]
+
+
+if __name__ == '__main__':
+    test_parameter_passing()
+    test_unknown_parameters_and_functions()
+    test_quotes()